@@ -0,0 +1,195 @@
+"""Benchmarks the pipeline on seeded synthetic query logs (see synthetic.py) and compares runs against a baseline.
+
+    python benchmark.py --sizes 1000 10000 100000 --save baseline.json
+    python benchmark.py --sizes 1000 10000 100000 --compare baseline.json
+    python benchmark.py --sizes 100000 --overlap 0.1 0.4 --mean-component-size 20 200 --component-skew 0.5 1.5
+
+A case is a size, a seed and the overlap and component-size distribution of the generated log (see
+synthetic.generate_query_log); every combination of the given values is a case. Every case records the wall and CPU
+time, calls and peak RSS of each stage and the final score. Every run starts in a fresh process, so the peak RSS of a
+case is that of the case alone. Comparing fails (exit code 1) if the score of a case changed or a stage got slower
+than the tolerance allows; cases are matched by all their parameters. Ties in the pipeline follow the iteration order
+of sets, so the benchmark runs with a fixed PYTHONHASHSEED to make scores comparable."""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from multiprocessing import get_context
+
+from instrumentation import Instruments, instrumented, max_rss
+from oct import compute_independent_set, compute_relations, compute_tree_score, load_and_preprocess
+from oct_placement import compute_tree
+from similarity_functions import Jaccard, F1, PerfectRecall, Exact
+from synthetic import generate_query_log, write_query_log
+
+
+BENCH_DIR = 'bench_data'
+HASH_SEED = '0'
+STAGES = ['preprocess', 'relations', 'independent set', 'tree', 'score']
+SIM_FUNCS = {'jaccard': Jaccard, 'f1': F1, 'perfect-recall': PerfectRecall, 'exact': Exact}
+
+
+def query_log_file(num_queries, seed, directory=BENCH_DIR, overlap=0.2, mean_component_size=50, component_skew=1.0):
+    """The file of the synthetic log with the given parameters, generated on first use."""
+
+    file_name = os.path.join(directory, 'synthetic_%d_%d_%g_%d_%g.jsonl' % (num_queries, seed, overlap,
+                                                                            mean_component_size, component_skew))
+    if not os.path.exists(file_name):
+        os.makedirs(directory, exist_ok=True)
+        log = generate_query_log(num_queries, seed, mean_component_size=mean_component_size,
+                                 component_skew=component_skew, overlap=overlap)
+        write_query_log(log, file_name + '.tmp')
+        os.replace(file_name + '.tmp', file_name)
+    return file_name
+
+
+def run_case(file_name, sim_func, merge_threshold, graph_solver='greedy', hypergraph_solver='greedy',
+             trace_memory=False):
+    """Runs the stages of the pipeline once and returns the records of the stages and the score."""
+
+    with instrumented(Instruments(trace_memory=trace_memory)) as instruments:
+        comps, data_stats = load_and_preprocess(file_name)
+        components, relations_stats = compute_relations(comps, sim_func)
+        indp_set_stats = compute_independent_set(components, graph_solver, hypergraph_solver) if components else {}
+        if sim_func.name == 'Exact':
+            tree_stats = {}
+            indp_set_weight = sum(q.w for comp in components for q in comp.indp_set)
+            score = round((indp_set_weight + data_stats['trivial']) / data_stats['total'], 3)
+        else:
+            _, tree_stats = compute_tree(components, sim_func, merge_threshold)
+            score = compute_tree_score(components, sim_func, data_stats['total'], data_stats['trivial'])
+    stages = instruments.to_dict()['stages']
+    return {'stages': {name: stages[name] for name in STAGES if name in stages},
+            'counters': instruments.to_dict()['counters'],
+            'score': score,
+            'components': data_stats['components'],
+            'pair conflicts': relations_stats['pair conflicts'],
+            'triple conflicts': relations_stats['triple conflicts'],
+            'weight of independent set': indp_set_stats.get('weight of independent set'),
+            'categories': tree_stats.get('categories'),
+            'max rss': max_rss()}
+
+
+def run_isolated(*args):
+    """run_case in a fresh process, so that the peaks of earlier runs do not show in its max rss."""
+
+    with get_context('spawn').Pool(1) as pool:
+        return pool.apply(run_case, args)
+
+
+def run_benchmark(sizes, seeds, sim_func, merge_threshold, repeat=1, trace_memory=False, directory=BENCH_DIR,
+                  overlaps=(0.2,), mean_component_sizes=(50,), component_skews=(1.0,)):
+    """Runs every case repeat times and keeps the fastest run of each stage. A case is keyed by
+    size/seed/overlap/mean component size/component skew."""
+
+    cases = {}
+    for num_queries, seed, overlap, mean_component_size, component_skew in itertools.product(
+            sizes, seeds, overlaps, mean_component_sizes, component_skews):
+        file_name = query_log_file(num_queries, seed, directory, overlap, mean_component_size, component_skew)
+        runs = [run_isolated(file_name, sim_func, merge_threshold, 'greedy', 'greedy', trace_memory)
+                for _ in range(repeat)]
+        case = runs[0]
+        for name in case['stages']:
+            for k in ('wall time', 'cpu time'):
+                case['stages'][name][k] = min(run['stages'][name][k] for run in runs)
+        case['queries'] = num_queries
+        case['seed'] = seed
+        case['overlap'] = overlap
+        case['mean component size'] = mean_component_size
+        case['component skew'] = component_skew
+        key = '%d/%d/%g/%d/%g' % (num_queries, seed, overlap, mean_component_size, component_skew)
+        cases[key] = case
+        print_case(key, case)
+    return {'sim func': sim_func.name, 'delta': getattr(sim_func, 'delta', None), 'merge threshold': merge_threshold,
+            'hash seed': os.environ.get('PYTHONHASHSEED'), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'cases': cases}
+
+
+def compare(results, baseline, tolerance=0.25, min_seconds=0.1):
+    """Returns the regressions of results against baseline: changed scores, and stages whose wall time grew by more
+    than tolerance (relative) and min_seconds (absolute)."""
+
+    regressions = []
+    for key in ('sim func', 'delta', 'merge threshold', 'hash seed'):
+        if results.get(key) != baseline.get(key):
+            regressions.append('%s is %s in the baseline and %s now' % (key, baseline.get(key), results.get(key)))
+    for name, case in results['cases'].items():
+        base = baseline['cases'].get(name)
+        if base is None:
+            continue
+        if case['score'] != base['score']:
+            regressions.append('%s: score %s -> %s' % (name, base['score'], case['score']))
+        for stage, record in case['stages'].items():
+            if stage not in base['stages']:
+                continue
+            old, new = base['stages'][stage]['wall time'], record['wall time']
+            if new > old * (1 + tolerance) and new - old > min_seconds:
+                change = ' (%+.0f%%)' % (100 * (new / old - 1)) if old else ''
+                regressions.append('%s: %s %.3fs -> %.3fs%s' % (name, stage, old, new, change))
+    return regressions
+
+
+def print_case(name, case):
+    times = '  '.join('%s %.3fs' % (stage, record['wall time']) for stage, record in case['stages'].items())
+    print('%-24s score %.3f  %s  max rss %.0f MB' % (name, case['score'], times, case['max rss'] / 2 ** 20))
+
+
+def print_comparison(results, baseline):
+    print('\n%-24s %-20s %10s %10s %8s' % ('case', 'stage', 'baseline', 'now', 'change'))
+    for name, case in results['cases'].items():
+        base = baseline['cases'].get(name)
+        if base is None:
+            continue
+        for stage, record in case['stages'].items():
+            if stage in base['stages']:
+                old, new = base['stages'][stage]['wall time'], record['wall time']
+                change = '%+.0f%%' % (100 * (new / old - 1)) if old else ''
+                print('%-24s %-20s %9.3fs %9.3fs %8s' % (name, stage, old, new, change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='numbers of queries, e.g. 1000 10000 100000 1000000')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0])
+    parser.add_argument('--overlap', type=float, nargs='+', default=[0.2],
+                        help='probabilities that a query also returns products of another branch')
+    parser.add_argument('--mean-component-size', type=int, nargs='+', default=[50],
+                        help='mean numbers of queries per connected component')
+    parser.add_argument('--component-skew', type=float, nargs='+', default=[1.0],
+                        help='Zipf exponents of the component sizes; larger gives a larger giant component')
+    parser.add_argument('--sim-func', choices=sorted(SIM_FUNCS), default='jaccard')
+    parser.add_argument('--delta', type=float, default=0.8)
+    parser.add_argument('--merge-threshold', type=float, default=0.5)
+    parser.add_argument('--repeat', type=int, default=1, help='runs per case; the fastest run of each stage is kept')
+    parser.add_argument('--trace-memory', action='store_true', help='peak memory of each stage by tracemalloc')
+    parser.add_argument('--data-dir', default=BENCH_DIR, help='where the generated logs are kept')
+    parser.add_argument('--save', help='write the results to this file, to be a baseline')
+    parser.add_argument('--compare', help='compare against a baseline written by --save')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown of a stage')
+    parser.add_argument('--min-seconds', type=float, default=0.1, help='allowed absolute slowdown of a stage')
+    args = parser.parse_args(argv)
+    if argv is None and os.environ.get('PYTHONHASHSEED') != HASH_SEED:
+        os.execve(sys.executable, [sys.executable] + sys.argv, dict(os.environ, PYTHONHASHSEED=HASH_SEED))
+
+    results = run_benchmark(args.sizes, args.seeds, SIM_FUNCS[args.sim_func](args.delta), args.merge_threshold,
+                            args.repeat, args.trace_memory, args.data_dir, args.overlap, args.mean_component_size,
+                            args.component_skew)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print_comparison(results, baseline)
+        regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,288 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from elements import ELM_DTYPE, ElementIndex, decode_strings, encode_strings
+from instrumentation import count
+from oct import Component, IntersectingPairs, Query, add_to_list_in_dict, compute_independent_set, \
+    compute_relations, indp_set_stats, load_and_preprocess, relations_stats
+
+
+CACHE_MAX_BYTES = 1 << 30
+CACHED_MODULES = ['oct.py', 'elements.py', 'input_reader.py', 'similarity_functions.py', 'independent_set.py',
+                  'sketches.py', 'cache.py']
+
+
+def code_version():
+    """Hash of the sources of the cached stages, so that artifacts of older code are never reused."""
+
+    digest = hashlib.sha1()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for module in CACHED_MODULES:
+        with open(os.path.join(directory, module), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def file_digest(file_name, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactCache(object):
+    """Content-addressed on-disk store for the results of preprocessing, relations and independent sets.
+    Every artifact is a .npz of plain arrays named by the hash of its key: the input file hash, the parameters
+    of the stage and its preceding stages and the code version. Loading an artifact marks it as recently used, and
+    the least recently used artifacts are evicted once the directory holds more than max_bytes.
+    The preprocessing key is kept in data_stats['cache key'] and the later stages are keyed on it, so a run that
+    changes only tree building parameters starts at tree building."""
+
+    def __init__(self, directory, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.version = code_version()
+        self.hits, self.misses = 0, 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, *parts):
+        return hashlib.sha1(repr(parts + (self.version,)).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        path = self.path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        return arrays
+
+    def store(self, key, arrays):
+        path = self.path(key)
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temp_path, path)  # atomic, so concurrent workers never read a partial artifact
+        self.evict()
+
+    def evict(self):
+        """Other processes sharing the directory may evict at the same time, so artifacts that are gone already are
+        skipped."""
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries)[:-1]:  # the newest artifact is always kept
+            if total_size <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def load_and_preprocess(self, file_name, elm_index=None, near_duplicate_threshold=None, sketch=None):
+        """Cached load_and_preprocess. An ElementIndex passed in must be empty; it is filled as on a fresh load.
+        On a hit, the time in data_stats is that of loading the cached components."""
+
+        start_time_of_loading = time.process_time()
+        key = self.key('preprocess', file_digest(file_name), near_duplicate_threshold, repr(sketch))
+        arrays = self.load(key)
+        if arrays is None:
+            elm_index = elm_index if elm_index is not None else ElementIndex()
+            comps, data_stats = load_and_preprocess(file_name, elm_index, near_duplicate_threshold, sketch)
+            data_stats['cache key'] = key
+            self.store(key, pack_components(comps, data_stats, elm_index))
+            return comps, data_stats
+        comps, data_stats = unpack_components(arrays, elm_index, sketch)
+        data_stats['time: '] = round(time.process_time() - start_time_of_loading, 2)
+        return comps, data_stats
+
+    def relations_key(self, sim_func, data_stats):
+        return self.key('relations', data_stats['cache key'], sim_func.name, getattr(sim_func, 'delta', None))
+
+    def indp_set_key(self, sim_func, data_stats, graph_solver, hypergraph_solver):
+        """None unless both solvers are given by name, since solver objects are not keyed."""
+
+        if not (isinstance(graph_solver, str) and isinstance(hypergraph_solver, str)):
+            return None
+        return self.key('independent set', data_stats['cache key'], sim_func.name, getattr(sim_func, 'delta', None),
+                        graph_solver, hypergraph_solver)
+
+    def has_stages(self, sim_func, data_stats, graph_solver, hypergraph_solver):
+        """True if both the relations and the independent sets of a run are cached."""
+
+        indp_set_key = self.indp_set_key(sim_func, data_stats, graph_solver, hypergraph_solver)
+        return indp_set_key is not None and os.path.exists(self.path(indp_set_key)) and \
+            os.path.exists(self.path(self.relations_key(sim_func, data_stats)))
+
+    def store_stages(self, sim_func, data_stats, graph_solver, hypergraph_solver, relations, indp_sets):
+        """Stores the relations_positions and indp_set_positions of all components of a run built elsewhere
+        (e.g. in a process pool)."""
+
+        self.store(self.relations_key(sim_func, data_stats), pack_relations(relations))
+        indp_set_key = self.indp_set_key(sim_func, data_stats, graph_solver, hypergraph_solver)
+        if indp_set_key is not None:
+            self.store(indp_set_key, pack_independent_sets(indp_sets))
+
+    def compute_relations(self, comps, sim_func, data_stats, start_rank=0):
+        """Cached compute_relations over components from load_and_preprocess of this cache. On a hit the pair
+        relations, the triple conflicts and the decision counts of the sketch are restored without computing
+        intersections."""
+
+        key = self.relations_key(sim_func, data_stats)
+        arrays = self.load(key)
+        if arrays is None:
+            components, stats = compute_relations(comps, sim_func, start_rank)
+            self.store(key, pack_relations([relations_positions(comp) for comp in components]))
+            return components, stats
+        start_time_of_computing_relations = time.process_time()
+        components = unpack_relations(arrays, comps, sim_func, start_rank)
+        relations_running_time = round(time.process_time() - start_time_of_computing_relations, 2)
+        return components, relations_stats(components, relations_running_time)
+
+    def compute_independent_set(self, components, sim_func, data_stats, graph_solver='greedy',
+                                hypergraph_solver='greedy'):
+        """Cached compute_independent_set. Only solvers given by name are cached."""
+
+        key = self.indp_set_key(sim_func, data_stats, graph_solver, hypergraph_solver)
+        arrays = self.load(key) if key is not None else None
+        if arrays is None:
+            stats = compute_independent_set(components, graph_solver, hypergraph_solver)
+            if key is not None:
+                self.store(key, pack_independent_sets([indp_set_positions(comp) for comp in components]))
+            return stats
+        start_time_of_computing_indp_set = time.process_time()
+        unpack_independent_sets(arrays, components)
+        return indp_set_stats(components, round(time.process_time() - start_time_of_computing_indp_set, 2))
+
+
+def pack_components(comps, data_stats, elm_index):
+    queries = [q for queries, _ in comps for q in queries]
+    name_data, name_offsets = encode_strings(q.name for q in queries)
+    elm_name_data, elm_name_offsets = encode_strings(elm_index.names)
+    elm_offsets = np.zeros(len(queries) + 1, dtype=np.int64)
+    np.cumsum([len(q) for q in queries], out=elm_offsets[1:])
+    return {'comp offsets': np.cumsum([0] + [len(queries) for queries, _ in comps]),
+            'names': name_data,
+            'name offsets': name_offsets,
+            'elms': np.concatenate([q.loaded_elms for q in queries]) if queries else np.zeros(0, dtype=ELM_DTYPE),
+            'elm offsets': elm_offsets,
+            'weights': np.array([q.w for q in queries]),
+            'ranks': np.array([q.r for q in queries], dtype=np.int64),
+            'elm names': elm_name_data,
+            'elm name offsets': elm_name_offsets,
+            'data stats': np.array(json.dumps(data_stats))}
+
+
+def unpack_components(arrays, elm_index=None, sketch=None):
+    if elm_index is not None:
+        if len(elm_index):
+            raise ValueError('the element index of a cached load must be empty')
+        for name in decode_strings(arrays['elm names'], arrays['elm name offsets']):
+            elm_index.intern(name)
+    names = decode_strings(arrays['names'], arrays['name offsets'])
+    elms, elm_offsets = arrays['elms'], arrays['elm offsets'].tolist()
+    queries = [Query(name, elms[elm_offsets[i]:elm_offsets[i + 1]], w, r) for i, (name, w, r) in
+               enumerate(zip(names, arrays['weights'].tolist(), arrays['ranks'].tolist()))]
+    comp_offsets = arrays['comp offsets'].tolist()
+    comps = []
+    for start, end in zip(comp_offsets, comp_offsets[1:]):
+        comps.append((queries[start:end], IntersectingPairs(queries[start:end], sketch)))
+    return comps, json.loads(arrays['data stats'].item())
+
+
+def relations_positions(comp):
+    """The conflicts (in the order of conflicts_dict, which is their insertion order), the must relation (in the
+    order of must_dict) and the triple conflicts of a component, as pairs and triples of positions of queries in the
+    component, and its decision counts (sketch decisions, sketch rejections, exact fallbacks and exact decisions)."""
+
+    position = {q: i for i, q in enumerate(comp.queries)}
+    conflicts = [(position[q1], position[q2]) for q1 in comp.conflicts_dict for q2 in comp.conflicts_dict[q1]]
+    must = [(position[q], position[p]) for q in comp.must_dict for p in comp.must_dict[q]]
+    triple_conflicts = [(position[c], position[p1], position[p2]) for c, p1, p2 in comp.triple_conflicts]
+    decisions = (comp.sketch_decisions, comp.sketch_rejections, comp.exact_fallbacks, comp.exact_decisions)
+    return conflicts, must, triple_conflicts, decisions
+
+
+def pack_relations(positions):
+    """Packs the relations_positions of all components."""
+
+    conflicts = [pair for comp_positions in positions for pair in comp_positions[0]]
+    must = [pair for comp_positions in positions for pair in comp_positions[1]]
+    triple_conflicts = [triple for comp_positions in positions for triple in comp_positions[2]]
+    return {'conflicts': np.array(conflicts, dtype=np.int32).reshape(-1, 2),
+            'conflict offsets': np.cumsum([0] + [len(comp_positions[0]) for comp_positions in positions]),
+            'must': np.array(must, dtype=np.int32).reshape(-1, 2),
+            'must offsets': np.cumsum([0] + [len(comp_positions[1]) for comp_positions in positions]),
+            'triple conflicts': np.array(triple_conflicts, dtype=np.int32).reshape(-1, 3),
+            'triple conflict offsets': np.cumsum([0] + [len(comp_positions[2]) for comp_positions in positions]),
+            'decisions': np.array([comp_positions[3] for comp_positions in positions], dtype=np.int64).reshape(-1, 4)}
+
+
+def unpack_relations(arrays, comps, sim_func, start_rank=0):
+    conflict_offsets, must_offsets = arrays['conflict offsets'].tolist(), arrays['must offsets'].tolist()
+    triple_offsets = arrays['triple conflict offsets'].tolist()
+    conflicts, must = arrays['conflicts'].tolist(), arrays['must'].tolist()
+    triple_conflicts, decisions = arrays['triple conflicts'].tolist(), arrays['decisions'].tolist()
+    components = []
+    for i, (queries, intersecting_pairs) in enumerate(comps):
+        comp = Component(queries, intersecting_pairs, start_rank + i, sim_func)
+        restore_relations(comp, conflicts[conflict_offsets[i]:conflict_offsets[i + 1]],
+                          must[must_offsets[i]:must_offsets[i + 1]],
+                          triple_conflicts[triple_offsets[i]:triple_offsets[i + 1]], decisions[i])
+        count('triple conflicts', len(comp.triple_conflicts), comp)
+        components.append(comp)
+    return components
+
+
+def restore_relations(comp, conflicts, must, triple_conflicts, decisions):
+    """Adds the conflicts, the must relation, the triple conflicts and the decision counts given by
+    relations_positions to a new component."""
+
+    qs = comp.queries
+    for i1, i2 in conflicts:
+        comp.conflicts.add((qs[i1], qs[i2]))
+        add_to_list_in_dict(comp.conflicts_dict, qs[i1], qs[i2])
+    for child, parent in must:
+        add_to_list_in_dict(comp.must_dict, qs[child], qs[parent])
+    comp.triple_conflicts = {(qs[c], qs[p1], qs[p2]) for c, p1, p2 in triple_conflicts}
+    comp.sketch_decisions, comp.sketch_rejections, comp.exact_fallbacks, comp.exact_decisions = decisions
+
+
+def indp_set_positions(comp):
+    """The independent set of a component (in its iteration order) as positions of queries in the component."""
+
+    position = {q: i for i, q in enumerate(comp.queries)}
+    return [position[q] for q in comp.indp_set]
+
+
+def pack_independent_sets(positions):
+    """Packs the indp_set_positions of all components."""
+
+    return {'indp set': np.array([i for comp_positions in positions for i in comp_positions], dtype=np.int32),
+            'offsets': np.cumsum([0] + [len(comp_positions) for comp_positions in positions])}
+
+
+def unpack_independent_sets(arrays, components):
+    indp_set, offsets = arrays['indp set'].tolist(), arrays['offsets'].tolist()
+    for i, comp in enumerate(components):
+        comp.indp_set = {comp.queries[j] for j in indp_set[offsets[i]:offsets[i + 1]]}
+        comp.all_elms = set(np.concatenate([q.elms for q in comp.indp_set]).tolist())
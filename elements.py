@@ -0,0 +1,126 @@
+import numpy as np
+
+
+ELM_DTYPE = np.int32
+
+
+class ElementIndex(object):
+    """Interns product IDs to dense ints. Names are only needed again when a tree is exported."""
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, name):
+        elm = self.ids.get(name)
+        if elm is None:
+            elm = len(self.names)
+            self.ids[name] = elm
+            self.names.append(name)
+        return elm
+
+    def encode(self, names):
+        return to_elm_array(self.intern(name) for name in names)
+
+    def decode(self, elms):
+        return [self.names[e] for e in elms]
+
+
+class ElementCounter(object):
+    """Running count of the distinct elements seen, over a bitmap indexed by element id."""
+
+    def __init__(self):
+        self.seen = np.zeros(0, dtype=bool)
+        self.count = 0
+
+    def update(self, elms):
+        if not elms.size:
+            return
+        top = int(elms[-1]) + 1
+        if top > len(self.seen):
+            grown = np.zeros(max(top, 2 * len(self.seen)), dtype=bool)
+            grown[:len(self.seen)] = self.seen
+            self.seen = grown
+        self.count += int(np.count_nonzero(~self.seen[elms]))
+        self.seen[elms] = True
+
+
+def to_elm_array(elms):
+    """Returns the elements as a sorted array of unique ids."""
+
+    return sorted_unique(np.fromiter(elms, dtype=ELM_DTYPE))
+
+
+def sorted_unique(elms):
+    """The distinct ids of an id array, sorted. Faster than np.unique, which hashes the ids before sorting."""
+
+    elms = np.sort(elms)
+    if elms.size:
+        elms = elms[np.concatenate(([True], elms[1:] != elms[:-1]))]
+    return elms
+
+
+def union(arrays):
+    """Union of sorted id arrays."""
+
+    return sorted_unique(np.concatenate(arrays))
+
+
+def inter_size(a, b):
+    """Size of the intersection of two element collections, each either a sorted id array or a set of ids."""
+
+    if type(a) is np.ndarray:
+        if type(b) is np.ndarray:
+            if a.size > b.size:
+                a, b = b, a
+            return int(np.count_nonzero(isin_sorted(a, b)))
+        return len(b.intersection(a.tolist()))
+    if type(b) is np.ndarray:
+        return len(a.intersection(b.tolist()))
+    return len(a & b)
+
+
+def is_disjoint(a, b):
+    if type(a) is np.ndarray:
+        if type(b) is np.ndarray:
+            if a.size > b.size:
+                a, b = b, a
+            return not isin_sorted(a, b).any()
+        return b.isdisjoint(a.tolist())
+    if type(b) is np.ndarray:
+        return a.isdisjoint(b.tolist())
+    return a.isdisjoint(b)
+
+
+def contains(elms, e):
+    if type(elms) is np.ndarray:
+        i = np.searchsorted(elms, e)
+        return i < elms.size and elms[i] == e
+    return e in elms
+
+
+def isin_sorted(elms, sorted_elms):
+    """Mask of the elements of an id array that are in a sorted id array, by binary search."""
+
+    if not sorted_elms.size:
+        return np.zeros(len(elms), dtype=bool)
+    i = np.searchsorted(sorted_elms, elms)
+    return sorted_elms[np.minimum(i, sorted_elms.size - 1)] == elms
+
+
+def encode_strings(strings):
+    """Packs strings into one utf-8 byte array and the offsets of the strings in it."""
+
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def decode_strings(data, offsets):
+    data = data.tobytes()
+    offsets = offsets.tolist()
+    return [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
@@ -0,0 +1,202 @@
+import time
+from itertools import chain
+
+from elements import ElementIndex
+from instrumentation import timed
+from oct import Query, compute_independent_set, compute_relations, compute_tree_score, get_connected_components, \
+    load_raw_queries
+from oct_placement import compute_tree
+from tree_walk import preorder
+
+
+class IncrementalTree(object):
+    """Maintains the components and trees of a query log under deltas of added, removed and reweighted queries.
+    A delta only touches the connected components that contain an element of a changed query: their queries are
+    partitioned again (so components may merge or split), and only the new components go through relations, MIS,
+    placement and expansion. All other components keep their Component objects and trees.
+    The components and their queries are the ones load_and_preprocess would give for the same queries, but the
+    trees can differ from a build from scratch in ties: element ids are interned in arrival order, not in the order
+    of a fresh load, and placement breaks ties by element id, so some elements can end up in other categories and
+    the score can differ slightly.
+    Near-duplicate merging is not supported, since it depends on the order of queries across components."""
+
+    def __init__(self, sim_func, merge_threshold, graph_solver='greedy', hypergraph_solver='greedy', elm_index=None):
+        self.sim_func = sim_func
+        self.merge_threshold = merge_threshold
+        self.graph_solver = graph_solver
+        self.hypergraph_solver = hypergraph_solver
+        self.elm_index = elm_index if elm_index is not None else ElementIndex()
+        self.raw_queries, self.raw_weights = {}, {}
+        self.order = {}  # name -> arrival number, breaks ties between queries of the same length
+        self.next_order = 0
+        self.names_by_elms = {}  # elements (as bytes) -> names of the queries with these elements, in arrival order
+        self.reps = {}  # elements (as bytes) -> the Query standing for all queries with these elements
+        self.groups = {}  # group id -> queries of a connected component or of an isolated query
+        self.components = {}  # group id -> built Component, for the groups of at least two queries
+        self.elm_groups = {}  # element -> id of the group containing it
+        self.next_group = 0
+        self.short_weight = 0
+        self.isolated_weight = 0
+
+    def update(self, added=None, removed=(), reweighted=None):
+        """added maps names of new (or replaced) queries to (product IDs, weight), removed lists names to remove and
+        reweighted maps names to their new weights. Returns a report of the rebuilt components and of the
+        categories added, removed or changed (moved or with other actual elements)."""
+
+        added = {name: (self.elm_index.encode(product_ids), weight)
+                 for name, (product_ids, weight) in (added or {}).items()}
+        return self.apply(added, removed, reweighted or {})
+
+    @timed('incremental update')
+    def apply(self, added, removed, reweighted):
+        """Like update, with the elements of the added queries already interned."""
+
+        start_time_of_update = time.process_time()
+
+        # update the raw queries and collect the element sets whose representative query changes
+        dirty = set()
+        for name in chain(removed, added):
+            if name in self.raw_queries:
+                self.remove_raw_query(name, dirty)
+        for name, (elms, weight) in added.items():
+            self.add_raw_query(name, elms, weight, dirty)
+        for name, weight in reweighted.items():
+            elms = self.raw_queries[name]
+            if len(elms) <= 1:
+                self.short_weight += weight - self.raw_weights[name]
+            else:
+                dirty.add(elms.tobytes())
+            self.raw_weights[name] = weight
+
+        old_reps = [self.reps.pop(key) for key in dirty if key in self.reps]
+        new_reps = []
+        for key in dirty:
+            names = self.names_by_elms.get(key)
+            if names:
+                rep = Query(names[0], self.raw_queries[names[0]], self.raw_weights[names[0]], -1)
+                for name in names[1:]:
+                    rep.w += self.raw_weights[name]
+                self.reps[key] = rep
+                new_reps.append(rep)
+        self.rerank()
+
+        # the affected groups are those sharing an element with an old or a new representative
+        affected = {self.elm_groups[e] for q in chain(old_reps, new_reps) for e in q.loaded_elms.tolist()
+                    if e in self.elm_groups}
+        old_rep_ids = {id(q) for q in old_reps}
+        queries = [q for gid in affected for q in self.groups[gid] if id(q) not in old_rep_ids] + new_reps
+        queries.sort(reverse=True)
+        old_cats, num_old_components = {}, 0
+        for gid in affected:
+            group = self.groups.pop(gid)
+            for q in group:
+                for e in q.loaded_elms.tolist():
+                    self.elm_groups.pop(e, None)
+            if gid in self.components:
+                old_cats.update(category_snapshot(self.components.pop(gid)))
+                num_old_components += 1
+            else:
+                self.isolated_weight -= group[0].w
+
+        # partition the affected queries again and build only the new components
+        comps, isolated_weight = get_connected_components(queries)
+        self.isolated_weight += isolated_weight
+        in_comps = {id(q) for cc, _ in comps for q in cc}
+        for q in queries:
+            if id(q) not in in_comps:
+                self.add_group([q])
+        components, _ = compute_relations(comps, self.sim_func)
+        if components:
+            compute_independent_set(components, self.graph_solver, self.hypergraph_solver)
+            if self.sim_func.name != 'Exact':
+                compute_tree(components, self.sim_func, self.merge_threshold)
+        new_cats = {}
+        for comp in components:
+            self.components[self.add_group(comp.queries)] = comp
+            new_cats.update(category_snapshot(comp))
+
+        return {'components removed': num_old_components,
+                'components built': len(components),
+                'components kept': len(self.components) - len(components),
+                'added categories': sorted(new_cats.keys() - old_cats.keys()),
+                'removed categories': sorted(old_cats.keys() - new_cats.keys()),
+                'changed categories': sorted(name for name in new_cats.keys() & old_cats.keys()
+                                             if new_cats[name] != old_cats[name]),
+                'update time': round(time.process_time() - start_time_of_update, 2)}
+
+    def add_raw_query(self, name, elms, weight, dirty):
+        self.raw_queries[name], self.raw_weights[name] = elms, weight
+        self.order[name] = self.next_order
+        self.next_order += 1
+        if len(elms) <= 1:
+            self.short_weight += weight
+        else:
+            key = elms.tobytes()
+            self.names_by_elms.setdefault(key, []).append(name)
+            dirty.add(key)
+
+    def remove_raw_query(self, name, dirty):
+        elms, weight = self.raw_queries.pop(name), self.raw_weights.pop(name)
+        del self.order[name]
+        if len(elms) <= 1:
+            self.short_weight -= weight
+        else:
+            key = elms.tobytes()
+            self.names_by_elms[key].remove(name)
+            if not self.names_by_elms[key]:
+                del self.names_by_elms[key]
+            dirty.add(key)
+
+    def rerank(self):
+        """Ranks all representatives from largest to smallest, ties by arrival; the relative order of the queries
+        of untouched components does not change."""
+
+        reps = sorted(self.reps.values(), key=lambda q: (-len(q), self.order[q.name]))
+        for rank, q in enumerate(reps):
+            q.r = rank
+
+    def add_group(self, queries):
+        gid = self.next_group
+        self.next_group += 1
+        self.groups[gid] = queries
+        for q in queries:
+            for e in q.loaded_elms.tolist():
+                self.elm_groups[e] = gid
+        return gid
+
+    def get_components(self):
+        """The components in the order of load_and_preprocess: from largest to smallest, ties by largest query."""
+
+        return sorted(self.components.values(), key=lambda comp: (-comp.num_queries, comp.queries[0].r))
+
+    def data_stats(self):
+        total_weight = sum(self.raw_weights.values())
+        return {'short': self.short_weight,
+                'isolated': self.isolated_weight,
+                'trivial': self.short_weight + self.isolated_weight,
+                'total': total_weight,
+                'components': len(self.components)}
+
+    def score(self):
+        stats = self.data_stats()
+        components = self.get_components()
+        if self.sim_func.name == 'Exact':
+            indp_set_weight = sum(q.w for comp in components for q in comp.indp_set)
+            return round((indp_set_weight + stats['trivial']) / stats['total'], 3)
+        return compute_tree_score(components, self.sim_func, stats['total'], stats['trivial'])
+
+
+def category_snapshot(comp):
+    """Maps the name of every category of the tree of a component to its parent name and actual elements."""
+
+    return {cat.name: (cat.parent.name, frozenset(cat.actual_elms.tolist()))
+            for cat in preorder(comp.root) if cat.parent}
+
+
+def load_incremental_tree(file_name, sim_func, merge_threshold, graph_solver='greedy', hypergraph_solver='greedy'):
+    """Builds an IncrementalTree from an input file (see load_and_preprocess for the formats)."""
+
+    tree = IncrementalTree(sim_func, merge_threshold, graph_solver, hypergraph_solver)
+    raw_queries, raw_weights, _ = load_raw_queries(file_name, tree.elm_index)
+    tree.apply({name: (raw_queries[name], raw_weights[name]) for name in raw_queries}, (), {})
+    return tree
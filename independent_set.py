@@ -1,8 +1,62 @@
-import networkx as nx
+import heapq
+import os
+import subprocess
+import tempfile
+import time
 
+import numpy as np
 
 
-def solve_hypergraph_mis(queries, pair_conflicts, hyper_conflicts):
+EXACT_TIME_LIMIT = 10  # seconds of CPU time before the exact solvers give up and fall back to the greedy
+
+
+class SolverTimeout(Exception):
+    pass
+
+
+class SizeRouter(object):
+    """Picks a solver by the number of vertices of a component. routes is a list of (max_vertices, solver) pairs
+    in increasing order of max_vertices; larger components use the default solver."""
+
+    def __init__(self, routes, default='greedy'):
+        self.routes = routes
+        self.default = default
+
+    def pick(self, num_vertices):
+        for max_vertices, solver in self.routes:
+            if num_vertices <= max_vertices:
+                return solver
+        return self.default
+
+
+def resolve_solver(solver, registry, num_vertices):
+    if isinstance(solver, SizeRouter):
+        solver = solver.pick(num_vertices)
+    if isinstance(solver, str):
+        solver = registry[solver]
+    return solver
+
+
+def check_hypergraph_solver(solver):
+    """Rejects solvers of the graph MIS only (ExternalSolver), also as a choice of a SizeRouter."""
+
+    solvers = [s for _, s in solver.routes] + [solver.default] if isinstance(solver, SizeRouter) else [solver]
+    if any(isinstance(s, ExternalSolver) for s in solvers):
+        raise ValueError('an ExternalSolver solves the graph MIS only and cannot be the hypergraph solver')
+
+
+def solve_hypergraph_mis(queries, pair_conflicts, hyper_conflicts, solver='greedy'):
+    check_hypergraph_solver(solver)
+    solver = resolve_solver(solver, HYPERGRAPH_MIS_SOLVERS, len(queries))
+    return solver(queries, pair_conflicts, hyper_conflicts)
+
+
+def solve_graph_mis(nodes, edges, solver='greedy'):
+    solver = resolve_solver(solver, GRAPH_MIS_SOLVERS, len(nodes))
+    return solver(nodes, edges)
+
+
+def greedy_hypergraph_mis(queries, pair_conflicts, hyper_conflicts):
     all_conflicts = pair_conflicts | hyper_conflicts
     edges = {frozenset(cf) for cf in all_conflicts}
     degrees = {}
@@ -13,47 +67,232 @@ def solve_hypergraph_mis(queries, pair_conflicts, hyper_conflicts):
     ind_set_hyper_min = set(hyper_min_alg(edges.copy(), degrees.copy()))
     ind_set_hyper_max = hyper_max_alg(edges.copy(), degrees.copy())
     best_result = max([ind_set_hyper_min, ind_set_hyper_max], key=lambda s: sum(v.w for v in s))
-    print('min:', len(ind_set_hyper_min) + len(singletons), '   max:', len(ind_set_hyper_max) + len(singletons))
     ind_set = best_result | singletons
     return ind_set
 
 
-def solve_graph_mis(nodes, edges):
-    g = nx.Graph()
-    g.add_nodes_from(nodes)
-    g.add_edges_from(edges)
-    ind_set_wg = wg_alg(g)
+def greedy_graph_mis(nodes, edges):
+    indptr, indices = build_csr(nodes, edges)
+    ind_set_wg = wg_alg(nodes, indptr, indices)
     return ind_set_wg
 
 
+def exact_hypergraph_mis(queries, pair_conflicts, hyper_conflicts, time_limit=EXACT_TIME_LIMIT):
+    """Branch and reduce for the maximum weight independent set of a (small) conflict hypergraph.
+    Falls back to the greedy if the time limit is exceeded."""
+
+    try:
+        edges = {frozenset(cf) for cf in pair_conflicts | hyper_conflicts}
+        return branch_and_reduce(set(queries), edges, time.process_time() + time_limit)
+    except SolverTimeout:
+        return greedy_hypergraph_mis(queries, pair_conflicts, hyper_conflicts)
+
+
+def exact_graph_mis(nodes, edges, time_limit=EXACT_TIME_LIMIT):
+    """Branch and reduce for the maximum weight independent set of a (small) conflict graph.
+    Falls back to the greedy if the time limit is exceeded."""
+
+    try:
+        return branch_and_reduce(set(nodes), {frozenset(e) for e in edges}, time.process_time() + time_limit)
+    except SolverTimeout:
+        return greedy_graph_mis(nodes, edges)
+
+
+def branch_and_reduce(vertices, edges, deadline):
+    """An independent set may not contain all the vertices of any edge (edges may have more than two vertices)."""
+
+    best = [-1, set()]
+
+    def reduce(free, edges, weight, chosen):
+        changed = True
+        while changed:
+            changed = False
+            in_edges = set().union(*edges)
+            for v in free - in_edges:  # vertices without conflicts are always taken
+                chosen.add(v)
+                weight += v.w
+            free = free & in_edges
+            for v in free:  # take v if it only has pair conflicts, weighing at least as much as its neighbors
+                incident = [e for e in edges if v in e]
+                if all(len(e) == 2 for e in incident):
+                    neighbors = set().union(*incident) - {v}
+                    if v.w >= sum(u.w for u in neighbors):
+                        chosen.add(v)
+                        weight += v.w
+                        free = free - neighbors - {v}
+                        edges = {e for e in edges if e.isdisjoint(neighbors) and v not in e}
+                        changed = True
+                        break
+        return free, edges, weight, chosen
+
+    def branch(free, edges, weight, chosen):
+        if time.process_time() > deadline:
+            raise SolverTimeout()
+        free, edges, weight, chosen = reduce(free, edges, weight, set(chosen))
+        if weight + sum(v.w for v in free) <= best[0]:
+            return
+        if not edges:
+            best[0], best[1] = weight, chosen
+            return
+        degrees = {}
+        for e in edges:
+            for v in e:
+                degrees[v] = degrees.get(v, 0) + 1
+        v = max(degrees, key=lambda x: (degrees[x], x.w))
+        # include v: edges containing it shrink, and an edge shrunk to a single vertex excludes that vertex
+        excluded, included_edges = set(), set()
+        for e in edges:
+            if v in e:
+                rest = e - {v}
+                if len(rest) == 1:
+                    excluded |= rest
+                else:
+                    included_edges.add(rest)
+            else:
+                included_edges.add(e)
+        included_edges = {e for e in included_edges if e.isdisjoint(excluded)}
+        branch(free - excluded - {v}, included_edges, weight + v.w, chosen | {v})
+        # exclude v
+        branch(free - {v}, {e for e in edges if v not in e}, weight, chosen)
+
+    branch(vertices, edges, 0, set())
+    return best[1]
+
+
+def write_metis_graph(nodes, edges, file_name, weight_scale=1):
+    """Writes the conflict graph in METIS format with integer node weights (as read by KaMIS).
+    Vertex i of the file (1-based) is nodes[i - 1]."""
+
+    position = {v: i for i, v in enumerate(nodes)}
+    neighbors = [set() for _ in nodes]
+    for u, v in edges:
+        neighbors[position[u]].add(position[v] + 1)
+        neighbors[position[v]].add(position[u] + 1)
+    num_edges = sum(len(ns) for ns in neighbors) // 2
+    with open(file_name, 'w') as metis_file:
+        metis_file.write(f'{len(nodes)} {num_edges} 10\n')
+        for v, ns in zip(nodes, neighbors):
+            line = [str(max(1, int(round(v.w * weight_scale))))] + [str(u) for u in sorted(ns)]
+            metis_file.write(' '.join(line) + '\n')
+
+
+class ExternalSolver(object):
+    """Solves the graph MIS with an external binary, such as KaMIS's weighted_branch_reduce.
+    args is formatted with the graph file, the output file and the time limit of the component. The output file
+    must hold one 0/1 line per vertex. If the binary fails, times out or returns a set that is not independent,
+    the greedy is used instead."""
+
+    def __init__(self, command, args=('{graph}', '--output={output}', '--time_limit={time_limit}'), time_limit=60,
+                 weight_scale=1, fallback='greedy'):
+        self.command = command
+        self.args = args
+        self.time_limit = time_limit
+        self.weight_scale = weight_scale
+        self.fallback = fallback
+
+    def __call__(self, nodes, edges):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            graph_file, output_file = os.path.join(tmp_dir, 'conflicts.graph'), os.path.join(tmp_dir, 'mis.txt')
+            write_metis_graph(nodes, edges, graph_file, self.weight_scale)
+            args = [a.format(graph=graph_file, output=output_file, time_limit=self.time_limit) for a in self.args]
+            try:
+                subprocess.run([self.command] + args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               timeout=self.time_limit * 1.5 + 5, check=True)
+                with open(output_file) as result_file:
+                    flags = [line.strip() == '1' for line in result_file if line.strip()]
+            except (OSError, subprocess.SubprocessError):
+                flags = []
+        ind_set = {v for v, flag in zip(nodes, flags) if flag}
+        if len(flags) != len(nodes) or any(u in ind_set and v in ind_set for u, v in edges):
+            return resolve_solver(self.fallback, GRAPH_MIS_SOLVERS, len(nodes))(nodes, edges)
+        return ind_set
+
+
+def build_csr(nodes, edges):
+    """Returns the adjacency of the graph in CSR form over the positions of the nodes.
+    The neighbors of each node are listed in the order of the networkx graph the greedy used to run on. That was
+    a copy of the graph, and Graph.copy re-adds the edges node by node, so the order is not that of the edges:
+    first the neighbors that precede the node (by position), then the following ones in the order in which their
+    edges are given. The initial weighted degrees are summed in this order (their updates iterate sets), which
+    keeps their floating point values, and so the chosen set, unchanged."""
+
+    position = {v: i for i, v in enumerate(nodes)}
+    ends = np.array([(position[u], position[v]) for u, v in edges], dtype=np.int64).reshape(-1, 2)
+    sources = np.concatenate([ends[:, 0], ends[:, 1]])
+    targets = np.concatenate([ends[:, 1], ends[:, 0]])
+    edge_order = np.tile(np.arange(len(ends)), 2)
+    neighbor_order = np.where(targets < sources, targets, len(nodes) + edge_order)
+    indices = targets[np.lexsort((neighbor_order, sources))]
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=len(nodes)), out=indptr[1:])
+    return indptr, indices
+
+
+def build_incidence(edges):
+    """Maps each vertex to the set of hyperedges incident to it."""
+
+    incidence = {}
+    for e in edges:
+        for v in e:
+            if v in incidence:
+                incidence[v].add(e)
+            else:
+                incidence[v] = {e}
+    return incidence
+
+
 def hyper_min_alg(edges, degrees):
+    # lazy-deletion heap keyed by (degree, 1 / w); ties are broken by the order of the degrees dict
+    order = {v: i for i, v in enumerate(degrees)}
+    incidence = build_incidence(edges)
+    heap = [(d, 1 / v.w, order[v], v) for v, d in degrees.items()]
+    heapq.heapify(heap)
+
+    def remove_edge(edge):
+        edges.remove(edge)
+        for x in edge:
+            incidence[x].discard(edge)
+
+    def add_edge(edge):
+        edges.add(edge)
+        for x in edge:
+            incidence[x].add(edge)
+
+    def decrease_degree(x):
+        degrees[x] -= 1
+        heapq.heappush(heap, (degrees[x], 1 / x.w, order[x], x))
+        if degrees[x] == 0:
+            zero_degree.append(x)
+
     ind_set = []
     while degrees:
-        min_node = min(degrees.keys(), key=lambda vertex: (degrees[vertex], 1 / vertex.w))
+        d, _, _, min_node = heapq.heappop(heap)
+        if min_node not in degrees or degrees[min_node] != d:
+            continue
         ind_set.append(min_node)
         del degrees[min_node]
         to_remove = set()
-        neig_e = [e for e in edges if min_node in e]
+        zero_degree = []
+        neig_e = list(incidence[min_node])
         for e in neig_e:
-            edges.remove(e)
+            remove_edge(e)
             others = frozenset(q for q in e if q != min_node)
             if len(others) == 1:
                 for u in others:
                     to_remove.add(u)
             elif others in edges:
                 for u in others:
-                    degrees[u] -= 1
+                    decrease_degree(u)
             else:
-                edges.add(others)
+                add_edge(others)
         for u in to_remove:
             del degrees[u]
-        for e in edges.copy():
-            if not e.isdisjoint(to_remove):
-                edges.remove(e)
-                for v in e:
-                    if v not in to_remove and v in degrees:
-                        degrees[v] -= 1
-        singletons = [q for q in degrees if degrees[q] == 0]
+        for e in set().union(*[incidence[u] for u in to_remove]):
+            remove_edge(e)
+            for v in e:
+                if v not in to_remove and v in degrees:
+                    decrease_degree(v)
+        singletons = sorted((q for q in zero_degree if q in degrees and degrees[q] == 0), key=order.get)
         for q in singletons:
             ind_set.append(q)
             del degrees[q]
@@ -61,37 +300,63 @@ def hyper_min_alg(edges, degrees):
 
 
 def hyper_max_alg(edges, degrees):
+    # lazy-deletion heap keyed by (-degree, -1 / w); ties are broken by the order of the degrees dict
+    order = {v: i for i, v in enumerate(degrees)}
+    incidence = build_incidence(edges)
+    heap = [(-d, -1 / v.w, order[v], v) for v, d in degrees.items()]
+    heapq.heapify(heap)
     while edges:
-        max_node = max(degrees.keys(), key=lambda vertex: (degrees[vertex], 1 / vertex.w))
+        d, _, _, max_node = heapq.heappop(heap)
+        if max_node not in degrees or degrees[max_node] != -d:
+            continue
         del degrees[max_node]
-        to_remove = set()
-        neig_e = [e for e in edges if max_node in e]
-        for e in neig_e:
+        for e in incidence.pop(max_node, ()):
             edges.remove(e)
-            others = frozenset(q for q in e if q != max_node)
-            for u in others:
-                degrees[u] -= 1
+            for u in e:
+                if u != max_node:
+                    incidence[u].discard(e)
+                    degrees[u] -= 1
+                    heapq.heappush(heap, (-degrees[u], -1 / u.w, order[u], u))
     return set(degrees.keys())
 
 
 # AVERAGE WEIGHTED DEGREE ALGORITHM
-def wg_alg(conflict_g: nx.Graph):
-    g = conflict_g.copy()
+def wg_alg(nodes, indptr, indices):
+    # lazy-deletion heap keyed by (weighted degree, position of the node)
+    position = {v: i for i, v in enumerate(nodes)}
+    alive = [True] * len(nodes)
+
+    def neighbors(i):
+        return [nodes[j] for j in indices[indptr[i]:indptr[i + 1]].tolist() if alive[j]]
+
     weighted_degrees = {}
-    singletons = {n for n, d in g.degree if d == 0}
-    g.remove_nodes_from(singletons)
-    for v in g.nodes:
-        neigs_weight = sum(n.w for n in g.neighbors(v))
-        weighted_degrees[v] = neigs_weight / v.w
+    singletons = {v for i, v in enumerate(nodes) if indptr[i] == indptr[i + 1]}
+    heap = []
+    for i, v in enumerate(nodes):
+        if v in singletons:
+            alive[i] = False
+        else:
+            weighted_degrees[v] = sum(n.w for n in neighbors(i)) / v.w
+            heap.append((weighted_degrees[v], i))
+    heapq.heapify(heap)
     ind_set = singletons
-    while g.number_of_nodes():
-        min_node = min(g.nodes, key=lambda node: weighted_degrees[node])
+    while heap:
+        weighted_degree, i = heapq.heappop(heap)
+        if not alive[i] or weighted_degree != weighted_degrees[nodes[i]]:
+            continue
+        min_node = nodes[i]
         ind_set.add(min_node)
-        min_node_neighbors = set(g.neighbors(min_node))
+        min_node_neighbors = set(neighbors(i))
         to_remove = min_node_neighbors | {min_node}
         for neig in min_node_neighbors:
-            extended_neigs = set(g.neighbors(neig)) - to_remove
+            extended_neigs = set(neighbors(position[neig])) - to_remove
             for ext_neg in extended_neigs:
                 weighted_degrees[ext_neg] -= neig.w / ext_neg.w
-        g.remove_nodes_from(to_remove)
+                heapq.heappush(heap, (weighted_degrees[ext_neg], position[ext_neg]))
+        for v in to_remove:
+            alive[position[v]] = False
     return ind_set
+
+
+GRAPH_MIS_SOLVERS = {'greedy': greedy_graph_mis, 'exact': exact_graph_mis}
+HYPERGRAPH_MIS_SOLVERS = {'greedy': greedy_hypergraph_mis, 'exact': exact_hypergraph_mis}
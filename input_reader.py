@@ -0,0 +1,92 @@
+import gzip
+import json
+import re
+
+
+WHITESPACE = re.compile(r'\s*')
+CHUNK_SIZE = 1 << 20
+
+
+def iter_entries(file_name, chunk_size=CHUNK_SIZE):
+    """Yields the (query, [result set, weight]) entries of an input file one at a time.
+    The file is either a single JSON object in the format described in the README, or JSON Lines (.jsonl) where
+    each line is such an object, possibly with a single entry. Either may be gzip compressed (.gz)."""
+
+    opener = gzip.open if file_name.endswith('.gz') else open
+    with opener(file_name, 'rt') as input_file:
+        if file_name.endswith('.jsonl') or file_name.endswith('.jsonl.gz'):
+            for line in input_file:
+                if line.strip():
+                    yield from json.loads(line).items()
+        else:
+            yield from iter_json_object(input_file, chunk_size)
+
+
+def iter_json_object(json_file, chunk_size=CHUNK_SIZE):
+    """Incrementally parses a JSON object from a file, yielding its (key, value) pairs without holding
+    more than one value (plus a chunk of the file) in memory."""
+
+    decoder = json.JSONDecoder()
+    buf, pos, eof = '', 0, False
+
+    def read_more():
+        nonlocal buf, pos, eof
+        chunk = json_file.read(chunk_size)
+        if not chunk:
+            eof = True
+            return False
+        buf = buf[pos:] + chunk
+        pos = 0
+        return True
+
+    state, key = 'start', None
+    while True:
+        pos = WHITESPACE.match(buf, pos).end()
+        if pos == len(buf):
+            if read_more():
+                continue
+            raise ValueError('unexpected end of JSON input')
+        c = buf[pos]
+        if state == 'start':
+            if c != '{':
+                raise ValueError(f'expected a JSON object, found {c!r}')
+            pos += 1
+            state = 'first key'
+        elif state in ('first key', 'key'):
+            if c == '}' and state == 'first key':
+                return
+            try:
+                key, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if read_more():
+                    continue
+                raise
+            if type(key) is not str:
+                raise ValueError(f'expected a string key, found {key!r}')
+            pos = end
+            state = 'colon'
+        elif state == 'colon':
+            if c != ':':
+                raise ValueError(f'expected ":" after key {key!r}, found {c!r}')
+            pos += 1
+            state = 'value'
+        elif state == 'value':
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if read_more():
+                    continue
+                raise
+            if end == len(buf) and not eof and read_more():
+                continue  # the value (e.g. a number) may continue in the next chunk
+            pos = end
+            yield key, value
+            state = 'separator'
+        else:
+            if c == ',':
+                state = 'key'
+            elif c == '}':
+                return
+            else:
+                raise ValueError(f'expected "," or "}}" after the value of {key!r}, found {c!r}')
+            pos += 1
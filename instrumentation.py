@@ -0,0 +1,241 @@
+import cProfile
+import json
+import os
+import pstats
+import re
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def max_rss():
+    """Peak resident set size of the process in bytes (0 where it is not available)."""
+
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # kilobytes on Linux
+
+
+class Instruments(object):
+    """Collects wall and CPU time, calls and memory of every stage, and counters, in total and per component.
+    Stages nest (e.g. place duplicates runs within fix duplicates); a stage or counter of a component is added to the
+    component and to the total. Peak memory is the peak of the memory traced by tracemalloc during the stage, only
+    with trace_memory; max rss is the peak of the process up to the end of the stage.
+    With profile, the outermost stage running at any time is profiled by cProfile, and the profiles of all runs of
+    a stage are added up. The stages run in pool workers are merged in with their timers, counters and memory, but
+    without profiles."""
+
+    enabled = True
+
+    def __init__(self, profile=False, trace_memory=False):
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.stages = {}  # (stage, component or None) -> totals
+        self.counters = {}  # (counter, component or None) -> value
+        self.profiles = {}  # stage -> pstats.Stats
+        self.profiler = None
+        self.open_peaks = []  # peak traced memory of each open stage, innermost last
+        self.started_tracing = False
+
+    def settings(self):
+        """Arguments for the Instruments of a pool worker."""
+
+        return {'trace_memory': self.trace_memory}
+
+    @contextmanager
+    def stage(self, name, component=None):
+        profiler = None
+        if self.profile and self.profiler is None:
+            profiler = self.profiler = cProfile.Profile()
+            profiler.enable()
+        if self.trace_memory:
+            self.update_peaks()
+        self.open_peaks.append(0)
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+            if self.trace_memory:
+                self.update_peaks()
+            peak = self.open_peaks.pop()
+            if profiler is not None:
+                profiler.disable()
+                self.profiler = None
+                if name in self.profiles:
+                    self.profiles[name].add(profiler)
+                else:
+                    self.profiles[name] = pstats.Stats(profiler)
+            self.add_stage(name, component, {'calls': 1, 'wall time': wall, 'cpu time': cpu, 'peak memory': peak,
+                                             'max rss': max_rss()})
+
+    def update_peaks(self):
+        """Raises the peaks of the open stages to the peak traced since the last update, and starts a new peak."""
+
+        peak = tracemalloc.get_traced_memory()[1]
+        self.open_peaks = [max(p, peak) for p in self.open_peaks]
+        tracemalloc.reset_peak()
+
+    def add_stage(self, name, component, record):
+        for key in [(name, None)] + ([(name, str(component))] if component is not None else []):
+            totals = self.stages.get(key)
+            if totals is None:
+                self.stages[key] = dict(record)
+                continue
+            for k, v in record.items():
+                totals[k] = max(totals[k], v) if k in ('peak memory', 'max rss') else totals[k] + v
+
+    def count(self, name, n=1, component=None):
+        for key in [(name, None)] + ([(name, str(component))] if component is not None else []):
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def records(self):
+        """The totals of all stages and counters, to send from a pool worker to merge."""
+
+        return {'stages': [(name, record) for (name, component), record in self.stages.items() if component is None],
+                'counters': [(name, n) for (name, component), n in self.counters.items() if component is None]}
+
+    def merge(self, records, component=None):
+        for name, record in records['stages']:
+            self.add_stage(name, component, record)
+        for name, n in records['counters']:
+            self.count(name, n, component)
+
+    def to_dict(self):
+        result = {'stages': {}, 'counters': {}, 'components': {}, 'max rss': max_rss()}
+        for (name, component), record in self.stages.items():
+            record = {k: round(v, 6) if 'time' in k else v for k, v in record.items()}
+            if component is None:
+                result['stages'][name] = record
+            else:
+                result['components'].setdefault(component, {'stages': {}, 'counters': {}})['stages'][name] = record
+        for (name, component), n in self.counters.items():
+            if component is None:
+                result['counters'][name] = n
+            else:
+                result['components'].setdefault(component, {'stages': {}, 'counters': {}})['counters'][name] = n
+        return result
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self, prefix='ctcr'):
+        """The stages and counters in the Prometheus text exposition format, labeled by stage and component."""
+
+        metrics = [('stage_calls_total', 'counter', 'calls', 'Runs of the stage.'),
+                   ('stage_wall_seconds_total', 'counter', 'wall time', 'Wall time of the stage.'),
+                   ('stage_cpu_seconds_total', 'counter', 'cpu time', 'CPU time of the stage.'),
+                   ('stage_max_rss_bytes', 'gauge', 'max rss', 'Peak RSS of the process at the end of the stage.')]
+        if self.trace_memory:
+            metrics.append(('stage_peak_traced_bytes', 'gauge', 'peak memory', 'Peak traced memory in the stage.'))
+        lines = []
+        for metric, kind, field, help_text in metrics:
+            lines.append('# HELP %s_%s %s' % (prefix, metric, help_text))
+            lines.append('# TYPE %s_%s %s' % (prefix, metric, kind))
+            for (name, component), record in self.stages.items():
+                lines.append('%s_%s%s %s' % (prefix, metric, labels(stage=name, component=component), record[field]))
+        for counter in sorted({name for name, _ in self.counters}):
+            metric = '%s_%s_total' % (prefix, re.sub(r'\W+', '_', counter).strip('_').lower())
+            lines.append('# TYPE %s counter' % metric)
+            for (name, component), n in self.counters.items():
+                if name == counter:
+                    lines.append('%s%s %s' % (metric, labels(component=component), n))
+        lines.append('# TYPE %s_max_rss_bytes gauge' % prefix)
+        lines.append('%s_max_rss_bytes %s' % (prefix, max_rss()))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, file_name):
+        """Writes the Prometheus text format to .prom files, and JSON otherwise."""
+
+        with open(file_name, 'w') as f:
+            f.write(self.to_prometheus() if file_name.endswith('.prom') else self.to_json())
+
+    def dump_profiles(self, directory):
+        """Writes the profile of every profiled stage to <directory>/<stage>.prof (see pstats and snakeviz)."""
+
+        os.makedirs(directory, exist_ok=True)
+        for name, stats in self.profiles.items():
+            stats.dump_stats(os.path.join(directory, re.sub(r'\W+', '_', name) + '.prof'))
+
+
+class NullInstruments(object):
+    """Records nothing; active unless some Instruments are."""
+
+    enabled = False
+
+    def settings(self):
+        return None
+
+    def stage(self, name, component=None):
+        return nullcontext()
+
+    def count(self, name, n=1, component=None):
+        pass
+
+    def merge(self, records, component=None):
+        pass
+
+
+def labels(**kwargs):
+    escaped = ['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for k, v in kwargs.items() if v is not None]
+    return '{%s}' % ','.join(escaped) if escaped else ''
+
+
+_active = [NullInstruments()]
+
+
+def active():
+    return _active[-1]
+
+
+def activate(instruments):
+    if instruments.trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        instruments.started_tracing = True
+    _active.append(instruments)
+    return instruments
+
+
+def deactivate(instruments):
+    _active.remove(instruments)
+    if instruments.started_tracing:
+        tracemalloc.stop()
+        instruments.started_tracing = False
+
+
+@contextmanager
+def instrumented(instruments):
+    """Records the stages and counters of the pipeline run within the block in the given Instruments."""
+
+    activate(instruments)
+    try:
+        yield instruments
+    finally:
+        deactivate(instruments)
+
+
+def stage(name, component=None):
+    return _active[-1].stage(name, component)
+
+
+def count(name, n=1, component=None):
+    _active[-1].count(name, n, component)
+
+
+def timed(name):
+    """Decorator recording every call of a function as a stage."""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with _active[-1].stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
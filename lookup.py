@@ -0,0 +1,103 @@
+import numpy as np
+
+from elements import ELM_DTYPE
+from tree_walk import preorder
+
+
+class CategoryLookup(object):
+    """Finds the best covering category of the finished trees for batches of queries, e.g. for mapping incoming
+    search queries to categories at request time. Once duplicates are fixed, the categories containing an element
+    form a path from a top category, so each element is indexed by the deepest category containing it only; the
+    intersection of a query with a category is the number of its elements whose deepest category is the category or
+    one of its descendants. A batch is counted per (query, deepest category) and the counts are added up the
+    parents, one level at a time for all queries together.
+    A category covers a query as in scoring (see sim_func.is_covering_batch). For every similarity function the
+    covering score grows with the Jaccard similarity of the query and the category, so the best covering category
+    is the covering one of highest Jaccard similarity, and the deepest of those on ties.
+    Build a new lookup after the trees change."""
+
+    def __init__(self, components, sim_func, elm_index=None):
+        self.sim_func = sim_func
+        self.elm_index = elm_index
+        cats = [cat for comp in components for cat in preorder(comp.root) if cat is not comp.root]
+        pos = {id(cat): i for i, cat in enumerate(cats)}
+        self.names = [cat.name for cat in cats]
+        self.num_cats = len(cats)
+        self.parents = np.array([pos.get(id(cat.parent), -1) for cat in cats], dtype=np.int64)
+        self.depths = np.zeros(self.num_cats, dtype=np.int64)
+        for i, parent in enumerate(self.parents.tolist()):  # parents come first in preorder
+            if parent >= 0:
+                self.depths[i] = self.depths[parent] + 1
+        self.cat_lens = np.array([len(cat.actual_elms) for cat in cats], dtype=np.int64)
+
+        elms = np.concatenate([np.zeros(0, dtype=ELM_DTYPE)] + [cat.actual_elms for cat in cats])
+        owners = np.repeat(np.arange(self.num_cats), self.cat_lens)
+        num_elms = max(len(elm_index) if elm_index is not None else 0, int(elms.max()) + 1 if len(elms) else 0)
+        deepest = np.full(num_elms, -1, dtype=np.int64)
+        np.maximum.at(deepest, elms, self.depths[owners] * self.num_cats + owners)
+        self.deepest = np.where(deepest >= 0, deepest % max(self.num_cats, 1), -1)
+        in_tree = self.deepest >= 0
+        if not np.array_equal(np.bincount(elms, minlength=num_elms)[in_tree], self.depths[self.deepest[in_tree]] + 1):
+            raise ValueError('the categories of an element do not form a path; build the lookup from finished trees')
+
+    def __len__(self):
+        return self.num_cats
+
+    def encode(self, products):
+        """The distinct elements of a query given by product IDs (with an ElementIndex) or element ids, and its
+        size. Products that are not in the index count for the size of the query only."""
+
+        if self.elm_index is not None:
+            products = set(products)
+            ids = self.elm_index.ids
+            elms = np.array([e for e in (ids.get(p) for p in products) if e is not None], dtype=np.int64)
+            return elms, len(products)
+        elms = np.unique(np.asarray(list(products) if isinstance(products, (set, frozenset)) else products,
+                                    dtype=np.int64))
+        return elms, len(elms)
+
+    def count_intersections(self, queries):
+        """Returns (query indices, category positions, intersection sizes) of all intersecting pairs of the encoded
+        queries (arrays of distinct element ids) and the categories, sorted."""
+
+        q_lens = np.array([len(elms) for elms in queries], dtype=np.int64)
+        q_elms = np.concatenate(queries).astype(np.int64) if queries else np.zeros(0, dtype=np.int64)
+        q_idx = np.repeat(np.arange(len(queries)), q_lens)
+        known = (q_elms >= 0) & (q_elms < len(self.deepest))
+        cats = np.full(len(q_elms), -1, dtype=np.int64)
+        cats[known] = self.deepest[q_elms[known]]
+        keys, counts = np.unique(q_idx[cats >= 0] * self.num_cats + cats[cats >= 0], return_counts=True)
+        all_keys, all_counts = [keys], [counts]
+        q_idx, cat_pos = keys // max(self.num_cats, 1), keys % max(self.num_cats, 1)
+        while len(cat_pos):
+            up = self.parents[cat_pos] >= 0
+            q_idx, cat_pos, counts = q_idx[up], self.parents[cat_pos[up]], counts[up]
+            all_keys.append(q_idx * self.num_cats + cat_pos)
+            all_counts.append(counts)
+        keys, inverse = np.unique(np.concatenate(all_keys), return_inverse=True)
+        inter = np.bincount(inverse, weights=np.concatenate(all_counts), minlength=len(keys)).astype(np.int64)
+        return keys // max(self.num_cats, 1), keys % max(self.num_cats, 1), inter
+
+    def best_positions(self, queries, q_lens):
+        """For each encoded query of the given size, the position of its best covering category, or -1."""
+
+        q_lens = np.asarray(q_lens, dtype=np.int64)
+        q_idx, cat_pos, inter = self.count_intersections(queries)
+        covering = self.sim_func.is_covering_batch(q_lens[q_idx], self.cat_lens[cat_pos], inter)
+        q_idx, cat_pos, inter = q_idx[covering], cat_pos[covering], inter[covering]
+        jaccard = inter / (q_lens[q_idx] + self.cat_lens[cat_pos] - inter)
+        order = np.lexsort((cat_pos, -self.depths[cat_pos], -jaccard, q_idx))
+        q_idx, cat_pos = q_idx[order], cat_pos[order]
+        first = np.ones(len(q_idx), dtype=bool)
+        first[1:] = q_idx[1:] != q_idx[:-1]
+        best = np.full(len(queries), -1, dtype=np.int64)
+        best[q_idx[first]] = cat_pos[first]
+        return best
+
+    def lookup(self, queries):
+        """The name of the best covering category of every query (a set of product IDs, or of element ids without
+        an ElementIndex), or None for queries that no category covers."""
+
+        encoded = [self.encode(products) for products in queries]
+        best = self.best_positions([elms for elms, _ in encoded], [size for _, size in encoded])
+        return [self.names[p] if p >= 0 else None for p in best.tolist()]
@@ -1,14 +1,36 @@
-from oct import load_and_preprocess, compute_relations, compute_independent_set, verify, print_tree, \
-    compute_tree_score
-from oct_placement import compute_tree
+from cache import ArtifactCache
+from elements import ElementIndex
+from independent_set import SizeRouter, ExternalSolver
+from instrumentation import Instruments, activate, deactivate
+from oct import load_and_preprocess, print_tree
 from similarity_functions import Jaccard, F1, PerfectRecall, Exact
+from sketches import MinHashSketch
+from streaming import JsonLinesSink, stream_delta
+from sweep import run_delta, sweep_deltas, print_results_table
+from tree_file import export_tree
 
 
 DATA_FILE = 'bestbuy_apple.json'
+NEAR_DUPLICATE_THRESHOLD = None  # e.g. 0.95 merges queries whose result sets are that Jaccard-similar
+SKETCH = None  # e.g. MinHashSketch(num_hashes=128, min_size=256) estimates the intersections of large queries
+CACHE_DIR = None  # e.g. '.ctcr_cache' keeps preprocessing, relations and independent sets for later runs
+EXPORT_FILE = None  # e.g. 'tree.bin', a memory-mapped export of the tree for serving (see tree_file.TreeFile)
+STREAM_FILE = None  # e.g. 'trees.jsonl', every component tree written as it completes (see streaming)
+METRICS_FILE = None  # e.g. 'metrics.json', or 'metrics.prom' for the Prometheus text format (see instrumentation)
+PROFILE_DIR = None  # e.g. 'profiles', a cProfile dump of every stage
+TRACE_MEMORY = False  # peak memory of every stage by tracemalloc, which slows the run down
 
 
-connected_comps, data_stats = load_and_preprocess(DATA_FILE)
-total_weight, trivial_weight = data_stats['total'], data_stats['trivial']
+instruments = Instruments(PROFILE_DIR is not None, TRACE_MEMORY) if METRICS_FILE or PROFILE_DIR else None
+if instruments:
+    activate(instruments)
+
+elm_index = ElementIndex()
+cache = ArtifactCache(CACHE_DIR) if CACHE_DIR else None
+if cache:
+    connected_comps, data_stats = cache.load_and_preprocess(DATA_FILE, elm_index, NEAR_DUPLICATE_THRESHOLD, SKETCH)
+else:
+    connected_comps, data_stats = load_and_preprocess(DATA_FILE, elm_index, NEAR_DUPLICATE_THRESHOLD, SKETCH)
 print(data_stats)
 
 FUNC = Jaccard(0.0) # the parameter is just a default, that is overriden below
@@ -18,37 +40,51 @@ DELTAS = [0.95] #[0.7, 0.75, 0.8, 0.85, 0.9, 0.95, 0.99] #[0.5, 0.6, 0.7, 0.75,
 MERGE_THRESHOLD = 0.01
 PRINT_TREE = True
 VERIFY = True
+# worker processes for the deltas of a sweep, or for the components of a single delta (None for one per CPU);
+# a pool only pays off on logs with several large components
+PROCESSES = 1
 
-results = {}
-for delta in DELTAS:
-    FUNC.delta = delta
-    delta_results = {}
-    print('\n' + '*' * 10, 'delta =', delta, '*' * 10)
-
-    components, relations_stats = compute_relations(connected_comps, FUNC)
-    print(relations_stats)
-
-    independent_set_stats = compute_independent_set(components)
-    print(independent_set_stats)
+# MIS solvers: 'greedy', 'exact' (branch and reduce, for small components), or a SizeRouter between them,
+# e.g. SizeRouter([(50, 'exact')], default='greedy'). The graph solver can also be an ExternalSolver such as
+# ExternalSolver('path/to/KaMIS/deploy/weighted_branch_reduce', time_limit=60); it solves graphs only, so
+# components with triple conflicts always use the hypergraph solver
+GRAPH_SOLVER = 'greedy'
+HYPERGRAPH_SOLVER = 'greedy'
 
-    if FUNC.name == 'Exact':
-        indp_set_weight = independent_set_stats['weight of independent set']
-        final_score = round((indp_set_weight + trivial_weight) / total_weight, 3)
-        results[delta] = final_score
-    else: # *not* Exact variant
-        total_weight_covered, tree_stats = compute_tree(components, FUNC, MERGE_THRESHOLD)
-        print(tree_stats)
-        final_score = round((total_weight_covered + trivial_weight) / total_weight, 3)
-        print('FINAL SCORE:', final_score)
-        results[delta] = final_score
-
-        if VERIFY:
-            print('verified score:', compute_tree_score(components, FUNC, total_weight, trivial_weight))
-            verify(components)
-
-        if PRINT_TREE:
-            print_tree(components)
+if len(DELTAS) == 1:
+    delta = DELTAS[0]
+    print('\n' + '*' * 10, 'delta =', delta, '*' * 10)
+    if STREAM_FILE:  # the trees are written out as the components finish, and not kept
+        ignored = [name for name, value in (('PRINT_TREE', PRINT_TREE), ('EXPORT_FILE', EXPORT_FILE),
+                                            ('VERIFY', VERIFY)) if value]
+        if ignored:
+            print('%s ignored: the trees are not kept with STREAM_FILE' % ', '.join(ignored))
+        with JsonLinesSink(STREAM_FILE, elm_index) as sink:
+            delta_results = stream_delta(connected_comps, data_stats, FUNC, delta, MERGE_THRESHOLD, sink, PROCESSES,
+                                         GRAPH_SOLVER, HYPERGRAPH_SOLVER)
+        components = []
+        print(delta_results['relations'])
+        print(delta_results['independent set'])
+        if 'tree' in delta_results:
+            print(delta_results['tree'])
+        print('FINAL SCORE:', delta_results['score'])
+    else:  # the stats are printed as the stages finish
+        components, delta_results = run_delta(connected_comps, data_stats, FUNC, delta, MERGE_THRESHOLD, VERIFY,
+                                              PROCESSES, GRAPH_SOLVER, HYPERGRAPH_SOLVER, cache, verbose=True)
 
-if len(DELTAS) > 1:
+    if PRINT_TREE and FUNC.name != 'Exact':
+        print_tree(components)
+    if EXPORT_FILE and components and FUNC.name != 'Exact':
+        export_tree(components, elm_index, EXPORT_FILE)
+else:  # the deltas are independent jobs that share the preprocessing
+    results = sweep_deltas(connected_comps, data_stats, FUNC, DELTAS, MERGE_THRESHOLD, PROCESSES, VERIFY,
+                           GRAPH_SOLVER, HYPERGRAPH_SOLVER, cache)
     print('\nFinal Results:')
-    print(results)
\ No newline at end of file
+    print_results_table(results)
+
+if instruments:
+    deactivate(instruments)
+    if METRICS_FILE:
+        instruments.write(METRICS_FILE)
+    if PROFILE_DIR:
+        instruments.dump_profiles(PROFILE_DIR)
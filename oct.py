@@ -1,11 +1,13 @@
-import json
 import time
-from itertools import combinations
 
-import networkx as nx
-from networkx.algorithms.components import connected_components
+import numpy as np
 
-from independent_set import solve_hypergraph_mis, solve_graph_mis
+from elements import ELM_DTYPE, ElementCounter, ElementIndex, is_disjoint, isin_sorted, to_elm_array, union
+from independent_set import check_hypergraph_solver, solve_hypergraph_mis, solve_graph_mis
+from input_reader import iter_entries
+from instrumentation import count, stage, timed
+from scoring import CoverIndex
+from tree_walk import postorder, preorder, preorder_with_depth
 
 
 def add_to_list_in_dict(d, k, v):
@@ -18,34 +20,36 @@ def add_to_list_in_dict(d, k, v):
 class Query(object):
     def __init__(self, name, elms, weight, rank):
         self.name = name
-        self.elms = elms
+        self.elms = elms  # sorted array of element ids; those of its category once the core tree is built
+        self.loaded_elms = elms  # the elements as loaded, restored by Component for every run
         self.w = weight
         self.size = len(elms)
         self.r = rank  # larger queries have lower rank; rank is unique;
+        self.sketch = None  # MinHash signature of a large query in the approximate mode, see sketches
 
     def intersect(self, other):
         if type(other) is set:
-            return not self.elms.isdisjoint(other)
-        return not self.elms.isdisjoint(other.elms)
+            return not is_disjoint(self.elms, other)
+        return not is_disjoint(self.elms, other.elms)
 
     def issubset(self, other):
         if type(other) is set:
-            return self.elms.issubset(other)
-        return self.elms.issubset(other.elms)
+            return other.issuperset(self.elms.tolist())
+        return bool(np.isin(self.elms, other.elms, assume_unique=True).all())
 
     def __len__(self):
         return self.size
 
     def __and__(self, other):
-        return self.elms & other.elms
+        return np.intersect1d(self.elms, other.elms, assume_unique=True)
 
     def __or__(self, other):
-        return self.elms | other.elms
+        return np.union1d(self.elms, other.elms)
 
     def __sub__(self, other):
         if type(other) is set:
-            return self.elms - other
-        return self.elms - other.elms
+            return self.elms[[e not in other for e in self.elms.tolist()]]
+        return np.setdiff1d(self.elms, other.elms, assume_unique=True)
 
     def __gt__(self, other):
         return self.r < other.r
@@ -57,7 +61,7 @@ class Query(object):
         return self.r == other.r
 
     def __iter__(self):
-        return iter(self.elms)
+        return iter(self.elms.tolist())
 
     def __repr__(self):
         return self.name
@@ -67,19 +71,28 @@ class Query(object):
 
 
 class Category(object):
-    def __init__(self, name, query, depth=0):
+    def __init__(self, name, query):
         self.name = name
         self.query = query
         if query:
-            self.elms = query.elms
+            self.elms = query.elms  # grows with the descendants, and so does the query (see compute_tree)
         else:
-            self.elms = set()
-        self.actual_elms = set()
+            self.elms = np.zeros(0, dtype=ELM_DTYPE)
+        self.actual_elms = np.zeros(0, dtype=ELM_DTYPE)  # sorted arrays, replaced (never changed in place) on updates
         self.children = []
         self.parent = None
-        self.depth = depth
         self.covered_queries = set()
 
+    @property
+    def depth(self):
+        """Computed from the parent pointers, so moving a subtree needs no update of its depths."""
+
+        depth, cat = 0, self.parent
+        while cat is not None:
+            depth += 1
+            cat = cat.parent
+        return depth
+
     def __repr__(self):
         return self.name
 
@@ -87,6 +100,54 @@ class Category(object):
         return hash(repr(self))
 
 
+def pack_tree(root):
+    """Flattens a category tree in preorder into a parent array, the category names, the rank of the query of
+    each category (-1 for merged categories) and the actual elements of all categories in CSR form."""
+
+    cats, parents = [], []
+    stack = [(root, -1)]
+    while stack:
+        cat, parent = stack.pop()
+        parents.append(parent)
+        cats.append(cat)
+        for child in reversed(cat.children):
+            stack.append((child, len(cats) - 1))
+    offsets = np.zeros(len(cats) + 1, dtype=np.int64)
+    np.cumsum([len(cat.actual_elms) for cat in cats], out=offsets[1:])
+    elms = np.concatenate([cat.actual_elms for cat in cats]).astype(ELM_DTYPE, copy=False)
+    return {'names': [cat.name for cat in cats],
+            'parents': np.array(parents, dtype=np.int32),
+            'query ranks': np.array([cat.query.r if cat.query else -1 for cat in cats], dtype=np.int32),
+            'offsets': offsets,
+            'elms': elms}
+
+
+def unpack_tree(packed, queries):
+    """Rebuilds the Category objects of a packed tree and returns its root. The elements of every category are
+    recomputed from the queries of its subtree, and shared with its query as compute_tree leaves them."""
+
+    queries_by_rank = {q.r: q for q in queries}
+    offsets, elms = packed['offsets'], packed['elms']
+    cats = []
+    for i, (name, parent, rank) in enumerate(zip(packed['names'], packed['parents'].tolist(),
+                                                 packed['query ranks'].tolist())):
+        cat = Category(name, None)
+        cat.query = queries_by_rank.get(rank)
+        cat.actual_elms = elms[offsets[i]:offsets[i + 1]]
+        if parent >= 0:
+            cat.parent = cats[parent]
+            cat.parent.children.append(cat)
+        cats.append(cat)
+    for cat in postorder(cats[0]):
+        if cat.query:
+            cat.elms = cat.query.loaded_elms
+        if cat.children:
+            cat.elms = union([cat.elms] + [ch.elms for ch in cat.children])
+        if cat.query:
+            cat.query.elms = cat.elms
+    return cats[0]
+
+
 class Component(object):
     def __init__(self, queries, intersecting_pairs, rank, sim_func):
         self.queries = sorted(queries, reverse=True)
@@ -95,12 +156,19 @@ class Component(object):
         self.sim_func = sim_func
         self.w = sum(q.w for q in self.queries)
         self.num_queries = len(queries)
+        for q in self.queries:  # a run starts from the loaded elements, whatever an earlier tree made of them
+            q.elms = q.loaded_elms
         # self.names_index = {q.name: q for q in queries}
         self.conflicts = set()
         self.conflicts_dict = {}
         self.triple_conflicts = set()
+        self.triple_conflicts_time = 0
+        self.sketch_decisions = 0  # estimated to intersect, and the relation was decided by the estimate
+        self.sketch_rejections = 0  # estimated not to intersect, and decided by the estimate to have no relation
+        self.exact_fallbacks = 0  # estimated pairs resolved exactly since the relation was borderline
+        self.exact_decisions = 0  # pairs whose relation was computed from the exact intersection size
         self.must_dict = {}  # key is child, value is list of parents
-        self.root = Category('ROOT', None, 0)
+        self.root = Category('ROOT', None)
         self.categories_index = {'ROOT': self.root}
         self.direct_parents = {}
 
@@ -116,26 +184,114 @@ class Component(object):
     def __hash__(self):
         return hash(repr(self))
 
-    def compute_triple_conflicts(self):
-        for q in self.must_dict:
-            parents = self.must_dict[q]
-            for p1, p2 in combinations(parents, 2):
-                if p1 < p2:
-                    p1, p2 = p2, p1
-                if (p2 not in self.must_dict) or (p1 not in self.must_dict[p2]):
-                    if p1 not in self.conflicts_dict or p2 not in self.conflicts_dict[p1]:
-                        self.triple_conflicts.add((q, p1, p2))
+    def compute_triple_conflicts(self, chunk_size=1 << 20):
+        """A child with two must-parents that are neither in a must relation nor in conflict is a triple conflict.
+        The pairs of must-parents are generated from the must relation in CSR form, for about chunk_size pairs of
+        consecutive children at a time, and the pairs that are must or conflict edges are removed by code lookup,
+        where the code of a pair is larger * n + smaller over the positions of the queries. Triples are added in
+        the order of the pairwise enumeration."""
+
+        n = len(self.queries)
+        position = {q: i for i, q in enumerate(self.queries)}  # larger queries have smaller positions
+        children = list(self.must_dict)
+        num_parents = np.array([len(self.must_dict[q]) for q in children], dtype=np.int64)
+        must_codes = [position[p] * n + position[q] for q in children for p in self.must_dict[q]]
+        conflict_codes = [position[q1] * n + position[q2] for q1, q2 in self.conflicts]
+        related_codes = np.sort(np.array(must_codes + conflict_codes, dtype=np.int64))
+
+        pairs_ends = np.cumsum(num_parents * (num_parents - 1) // 2)
+        start = 0
+        while start < len(children):
+            stop = max(int(np.searchsorted(pairs_ends, (pairs_ends[start - 1] if start else 0) + chunk_size,
+                                           side='right')), start + 1)
+            chunk_num_parents = num_parents[start:stop]
+            parents = np.fromiter((position[p] for q in children[start:stop] for p in self.must_dict[q]),
+                                  dtype=np.int64, count=int(chunk_num_parents.sum()))
+            # every parent entry is paired with the entries that follow it in the list of the same child
+            group_ends = np.repeat(np.cumsum(chunk_num_parents), chunk_num_parents)
+            num_following = group_ends - np.arange(len(parents)) - 1
+            first = np.repeat(np.arange(len(parents)), num_following)
+            run_starts = np.cumsum(num_following) - num_following
+            second = first + 1 + np.arange(len(first)) - np.repeat(run_starts, num_following)
+            p1, p2 = np.minimum(parents[first], parents[second]), np.maximum(parents[first], parents[second])
+
+            unrelated = ~isin_sorted(p1 * n + p2, related_codes)
+            child_of_entry = start + np.repeat(np.arange(len(chunk_num_parents)), chunk_num_parents)
+            for c, i1, i2 in zip(child_of_entry[first[unrelated]].tolist(), p1[unrelated].tolist(),
+                                 p2[unrelated].tolist()):
+                self.triple_conflicts.add((children[c], self.queries[i1], self.queries[i2]))
+            start = stop
 
     def compute_relations(self):
-        for q1, q2 in self.intersecting_pairs:
-            relation = self.sim_func.compute_relation(q1, q2)
-            if relation == -1:
-                self.conflicts.add((q1, q2))
-                add_to_list_in_dict(self.conflicts_dict, q1, q2)
-            elif relation == 1:
-                    add_to_list_in_dict(self.must_dict, q2, q1)
+        pairs = list(self.intersecting_pairs)
+        len_q1 = np.array([q1.size for q1, _ in pairs], dtype=np.int64)
+        len_q2 = np.array([q2.size for _, q2 in pairs], dtype=np.int64)
+        inter = np.fromiter(self.intersecting_pairs.values(), dtype=np.int64, count=len(pairs))
+        relations = self.sim_func.compute_relation_batch(len_q1, len_q2, inter)
+        self.exact_decisions = len(pairs)
+        if self.intersecting_pairs.estimates:
+            pairs, relations = self.resolve_estimates(pairs, relations)
+        for i in np.flatnonzero(relations == -1).tolist():
+            q1, q2 = pairs[i]
+            self.conflicts.add((q1, q2))
+            add_to_list_in_dict(self.conflicts_dict, q1, q2)
+        for i in np.flatnonzero(relations == 1).tolist():
+            q1, q2 = pairs[i]
+            add_to_list_in_dict(self.must_dict, q2, q1)
+        count('pairs checked', len(pairs), self)
+        count('pair conflicts', len(self.conflicts), self)
+        count('must relations', int(np.count_nonzero(relations == 1)), self)
+        self.complete_relations()
+
+    def resolve_estimates(self, pairs, relations):
+        """Keeps the relation of an estimated pair only if it is the same at every point of the interval of its
+        intersection size (and the pair surely intersects, unless the relation is 0); the other estimated pairs are
+        resolved exactly. Estimated pairs that likely do not intersect are not in pairs, and are added if they do.
+        Returns the pairs and their relations."""
+
+        estimates = self.intersecting_pairs.estimates
+        index = {pair: i for i, pair in enumerate(pairs) if pair in estimates}
+        candidates = list(estimates)
+        len_q1 = np.array([q1.size for q1, _ in candidates], dtype=np.int64)
+        len_q2 = np.array([q2.size for _, q2 in candidates], dtype=np.int64)
+        bounds = np.array([estimates[pair] for pair in candidates], dtype=np.float64)
+        # the relation at the estimate: as computed for the pairs, and at 0 for those estimated not to intersect
+        decided = self.sim_func.compute_relation_batch(len_q1, len_q2, np.zeros(len(candidates)))
+        present = np.array([pair in index for pair in candidates], dtype=bool)
+        decided[present] = relations[[index[pair] for pair in candidates if pair in index]]
+        robust = (decided == 0) | (bounds[:, 0] >= 1)
+        for t in np.linspace(0, 1, 5):
+            inter = bounds[:, 0] + t * (bounds[:, 1] - bounds[:, 0])
+            robust &= self.sim_func.compute_relation_batch(len_q1, len_q2, inter) == decided
+
+        added, added_relations = [], []
+        for k in np.flatnonzero(~robust).tolist():
+            pair = candidates[k]
+            inter = self.intersecting_pairs.resolve(pair)
+            relation = self.sim_func.compute_relation_batch(len_q1[k:k + 1], len_q2[k:k + 1], np.array([inter]))[0]
+            if pair in index:
+                relations[index[pair]] = relation if inter else 0
+            elif inter:
+                added.append(pair)
+                added_relations.append(relation)
+        self.sketch_decisions += int(np.count_nonzero(robust & present))
+        self.sketch_rejections += int(np.count_nonzero(robust & ~present))
+        self.exact_decisions += int(np.count_nonzero(~robust)) - len(index)
+        self.exact_fallbacks += int(np.count_nonzero(~robust))
+        count('sketch decisions', int(np.count_nonzero(robust & present)), self)
+        count('sketch rejections', int(np.count_nonzero(robust & ~present)), self)
+        count('exact fallbacks', int(np.count_nonzero(~robust)), self)
+        return pairs + added, np.concatenate([relations, np.array(added_relations, dtype=relations.dtype)])
+
+    def complete_relations(self):
+        """Derives the triple conflicts from the pair relations, unless the similarity function rules them out."""
+
         if self.sim_func.name != 'Exact' and self.sim_func.delta < 1:
-            self.compute_triple_conflicts()
+            start_time_of_triple_conflicts = time.process_time()
+            with stage('triple conflicts', self):
+                self.compute_triple_conflicts()
+            self.triple_conflicts_time = time.process_time() - start_time_of_triple_conflicts
+            count('triple conflicts', len(self.triple_conflicts), self)
 
 
 def remove_short_queries(qrs, len_threshold=1):
@@ -149,60 +305,244 @@ def remove_short_queries(qrs, len_threshold=1):
 
 
 def remove_duplicates(qrs):
-    """Assumes queries are sorted from longest to shortest."""
-
-    duplicates = set()
-    len_qrs = len(qrs)
-    for i, q1 in enumerate(qrs):
-        if q1 not in duplicates:
-            l1 = len(q1)
-            for j in range(i + 1, len_qrs):
-                q2 = qrs[j]
-                if len(q2) != l1:
-                    break
-                if q2 not in duplicates and q1.elms == q2.elms:
-                    q1.w += q2.w
-                    duplicates.add(q2)
-    new_qrs = [q for q in qrs if q not in duplicates]
-    return new_qrs, len(duplicates)
-
-
-def get_intersecting_pairs(qrs):
-    intersecting_pairs = []
-    for q1, q2 in combinations(qrs, 2):
-        if q1.intersect(q2):
-            intersecting_pairs.append((q1, q2))
+    """Assumes queries are sorted from longest to shortest.
+    Queries are bucketed by a fingerprint of their elements and only queries in the same bucket are compared.
+    The first query of each group of duplicates is kept and gets the weights of the others."""
+
+    buckets = {}
+    new_qrs = []
+    num_duplicates = 0
+    for q in qrs:
+        bucket = buckets.setdefault(hash(q.elms.tobytes()), [])
+        original = next((kept_q for kept_q in bucket if np.array_equal(kept_q.elms, q.elms)), None)
+        if original is None:
+            bucket.append(q)
+            new_qrs.append(q)
+        else:
+            original.w += q.w
+            num_duplicates += 1
+    return new_qrs, num_duplicates
+
+
+def remove_near_duplicates(qrs, threshold):
+    """Assumes queries are sorted from longest to shortest.
+    Each query whose Jaccard similarity to an earlier kept query is at least the threshold is removed, and its
+    weight is added to the most similar such query (the larger one on ties)."""
+
+    inverted_index = {}  # over the kept queries only
+    new_qrs = []
+    num_near_duplicates = 0
+    for q in qrs:
+        inter_sizes = {}
+        for e in q:
+            for kept_q in inverted_index.get(e, ()):
+                inter_sizes[kept_q] = inter_sizes.get(kept_q, 0) + 1
+        best_q, best_similarity = None, threshold
+        for kept_q, inter in inter_sizes.items():
+            similarity = inter / (len(kept_q) + len(q) - inter)
+            if similarity > best_similarity or (similarity == best_similarity and (best_q is None or kept_q > best_q)):
+                best_q, best_similarity = kept_q, similarity
+        if best_q is None:
+            new_qrs.append(q)
+            for e in q:
+                add_to_list_in_dict(inverted_index, e, q)
+        else:
+            best_q.w += q.w
+            num_near_duplicates += 1
+    return new_qrs, num_near_duplicates
+
+
+def build_inverted_index(qrs):
+    """Maps each element to the list of queries containing it, ordered from largest to smallest query."""
+
+    inverted_index = {}
+    for q in qrs:
+        for e in q:
+            add_to_list_in_dict(inverted_index, e, q)
+    return inverted_index
+
+
+def get_intersecting_pairs(qrs, inverted_index):
+    """Returns a dict from each intersecting (larger, smaller) pair to the size of its intersection.
+    Candidates are taken only from co-occurrence in the posting lists of the inverted index, which may leave out
+    some queries (see IntersectingPairs)."""
+
+    intersecting_pairs = {}
+    for q1 in qrs:
+        inter_sizes = {}
+        for e in q1:
+            for q2 in inverted_index.get(e, ()):
+                if q2 < q1:
+                    inter_sizes[q2] = inter_sizes.get(q2, 0) + 1
+        for q2 in sorted(inter_sizes, reverse=True):
+            intersecting_pairs[(q1, q2)] = inter_sizes[q2]
     return intersecting_pairs
 
 
-def get_connected_components(qrs, intersecting_pairs):
-    """Removes isolated queries, and return list of components from largest to smallest."""
-    intersect_graph = nx.Graph()
-    intersect_graph.add_nodes_from(qrs)
-    intersect_graph.add_edges_from(intersecting_pairs)
+class IntersectingPairs(object):
+    """The intersecting pairs of a connected component, computed on first use from an inverted index over the
+    component alone (its elements are shared with no other component). Reads like the dict returned by
+    get_intersecting_pairs. The pairs are pickled with it once computed, so a process pool either computes them in
+    its workers or receives them (see materialize).
+
+    With a MinHashSketch (the approximate mode), the pairs of two queries that both have a sketch are not counted:
+    the inverted index holds only the other queries, and the intersection sizes of the pairs of sketched queries are
+    estimated from their signatures. estimates maps each estimated pair to its (lowest, highest) intersection size;
+    pairs holds the estimated size of those that likely intersect. Component.compute_relations keeps an estimate
+    only if the relation is the same over the whole interval, and resolves the others exactly."""
+
+    def __init__(self, queries, sketch=None):
+        self.queries = queries  # ordered from largest to smallest query
+        self.sketch = sketch
+        self._pairs = None
+        self._estimates = None
+
+    @property
+    def pairs(self):
+        return self.materialize()._pairs
+
+    @property
+    def estimates(self):
+        return self.materialize()._estimates
+
+    def materialize(self):
+        """Computes the pairs unless they are already, e.g. before several processes that need them are started."""
+
+        if self._pairs is None:
+            self.compute()
+        return self
+
+    def compute(self):
+        if self.sketch is None:
+            self._pairs = get_intersecting_pairs(self.queries, build_inverted_index(self.queries))
+            self._estimates = {}
+            return
+        large_qrs = [q for q in self.queries if self.sketch.is_sketched(q)]
+        small_qrs = [q for q in self.queries if not self.sketch.is_sketched(q)]
+        self._pairs = get_intersecting_pairs(self.queries, build_inverted_index(small_qrs))
+        self._estimates = {}
+        self.sketch.sign(large_qrs)
+        first, second, inter, inter_lo, inter_hi = self.sketch.estimate_pairs(large_qrs)
+        for i, j, est, lo, hi in zip(first.tolist(), second.tolist(), np.round(inter).tolist(), inter_lo.tolist(),
+                                     inter_hi.tolist()):
+            pair = (large_qrs[i], large_qrs[j])
+            self._estimates[pair] = (min(lo, est), max(hi, est))
+            if est > 0:
+                self._pairs[pair] = int(est)
+
+    def release(self):
+        """Drops the pairs and the estimates; they are computed again if used afterwards."""
+
+        self._pairs = None
+        self._estimates = None
+
+    def resolve(self, pair):
+        """Replaces the estimate of a pair with its exact intersection size, and returns it."""
+
+        q1, q2 = pair
+        inter = int(np.intersect1d(q1.elms, q2.elms, assume_unique=True).size)
+        del self._estimates[pair]
+        if inter:
+            self._pairs[pair] = inter
+        else:
+            self._pairs.pop(pair, None)
+        return inter
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __iter__(self):
+        return iter(self.pairs)
+
+    def __contains__(self, pair):
+        return pair in self.pairs
+
+    def __getitem__(self, pair):
+        return self.pairs[pair]
+
+    def items(self):
+        return self.pairs.items()
+
+    def keys(self):
+        return self.pairs.keys()
+
+    def values(self):
+        return self.pairs.values()
+
+
+@timed('connected components')
+def get_connected_components(qrs, sketch=None):
+    """Removes isolated queries, and return list of components from largest to smallest.
+    Queries sharing an element are united in a union-find, so no pair is materialized here;
+    the intersecting pairs of each component are computed only when its relations are (approximately with a
+    MinHashSketch, see IntersectingPairs)."""
+
+    parent = list(range(len(qrs)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    if qrs:
+        # unite every query with the first (largest) query containing each of its elements
+        sizes = [len(q) for q in qrs]
+        all_elms = np.concatenate([q.loaded_elms for q in qrs])  # q.elms may hold those of an earlier tree
+        owners = np.repeat(np.arange(len(qrs)), sizes)
+        unique_elms, inverse = np.unique(all_elms, return_inverse=True)
+        first_owner = np.full(unique_elms.size, len(qrs))
+        np.minimum.at(first_owner, inverse, owners)
+        links = np.stack([first_owner[inverse], owners], axis=1)
+        links = np.unique(links[links[:, 0] != links[:, 1]], axis=0)
+        for i, j in links.tolist():
+            ri, rj = find(i), find(j)
+            if ri != rj:
+                parent[max(ri, rj)] = min(ri, rj)
+
+    # group in order of the largest query of each component
+    groups = {}
+    for i, q in enumerate(qrs):
+        add_to_list_in_dict(groups, find(i), q)
     comps = []
     isolated_weight = 0
-    for cc in connected_components(intersect_graph):
+    for cc in groups.values():
         if len(cc) == 1:
-            isolated_weight += list(cc)[0].w
+            isolated_weight += cc[0].w
         else:
-            edges = list(intersect_graph.subgraph(cc).edges)
-            intersections = [(q1, q2) if q1 > q2 else (q2, q1) for q1, q2 in edges]
-            comps.append((cc, intersections))
+            comps.append((cc, IntersectingPairs(cc, sketch)))
     comps = sorted(comps, key=lambda c: len(c[0]), reverse=True)
     return comps, isolated_weight
 
 
-def load_and_preprocess(file_name):
+@timed('load')
+def load_raw_queries(file_name, elm_index):
+    """Returns the elements (interned with elm_index) and the weight of every query of the input file, in file order,
+    and the number of distinct elements."""
+
+    raw_queries, raw_weights = {}, {}
+    elms_counter = ElementCounter()
+    for q, entry in iter_entries(file_name):
+        raw_queries[q] = elm_index.encode(entry[0])
+        raw_weights[q] = entry[1] if len(entry) == 2 else 1
+        elms_counter.update(raw_queries[q])
+    return raw_queries, raw_weights, elms_counter.count
+
+
+@timed('preprocess')
+def load_and_preprocess(file_name, elm_index=None, near_duplicate_threshold=None, sketch=None):
+    """Pass an ElementIndex to keep the product IDs of the interned elements (e.g. for exporting the tree).
+    The input (JSON, JSON Lines, optionally gzipped) is streamed one entry at a time, see input_reader.
+    If near_duplicate_threshold is set, queries that are that Jaccard-similar to a larger query are merged into it.
+    With a MinHashSketch, the intersections of pairs of large queries are estimated (see IntersectingPairs)."""
+
     start_time_of_loading = time.process_time()
-    # load data
-    with open(file_name) as json_file:
-        json_data = json.load(json_file)
-    raw_queries = {q: set(json_data[q][0]) for q in json_data}
-    raw_weights = {q: json_data[q][1]  if len(json_data[q]) == 2 else 1 for q in json_data}
+    if elm_index is None:
+        elm_index = ElementIndex()
+    # load data entry by entry, interning product IDs to dense ints
+    raw_queries, raw_weights, total_num_elements = load_raw_queries(file_name, elm_index)
     total_weight = sum(raw_weights.values())  # this is only correct for unweighted inputs
     print(f'TOTAL WEIGHT: {total_weight}')
-    total_num_elements = len(set.union(*[elms for q, elms in raw_queries.items()]))
 
     # create query objects in sorted order from large to small and remove queries of length 1
     sorted_queries = sorted(raw_queries.keys(), key=lambda q: len(raw_queries[q]), reverse=True)
@@ -213,12 +553,11 @@ def load_and_preprocess(file_name):
 
     # remove duplicates and adjust weights
     Q, num_duplicates = remove_duplicates(Q)
-
-    # get list of tuples of all intersecting pairs
-    intersecting_pairs = get_intersecting_pairs(Q)
+    if near_duplicate_threshold is not None:
+        Q, num_near_duplicates = remove_near_duplicates(Q, near_duplicate_threshold)
 
     # partition into connected components and remove isolated queries
-    comps, isolated_weight = get_connected_components(Q, intersecting_pairs)
+    comps, isolated_weight = get_connected_components(Q, sketch)
 
     trivial_weight = short_weight + isolated_weight
     # Q_weight = total_weight - trivial_weight
@@ -235,98 +574,105 @@ def load_and_preprocess(file_name):
                   'elements': total_num_elements,
                   'time: ': preprocessing_running_time}
 
+    if near_duplicate_threshold is not None:
+        data_stats['near duplicates'] = num_near_duplicates
+
     return comps, data_stats
 
 
-def compute_relations(comps, sim_func):
+def compute_relations(comps, sim_func, start_rank=0):
     start_time_of_computing_relations = time.process_time()
     components = []
-    total_pair_conflicts, total_triple_conflicts = 0, 0
-    for rank, (queries, intersecting_pairs) in enumerate(comps):
+    for rank, (queries, intersecting_pairs) in enumerate(comps, start_rank):
         comp = Component(queries, intersecting_pairs, rank, sim_func)
         components.append(comp)
-        comp.compute_relations()
-        total_pair_conflicts += len(comp.conflicts)
-        total_triple_conflicts += len(comp.triple_conflicts)
+        with stage('relations', comp):
+            comp.compute_relations()
     computing_relations_running_time = round(time.process_time() - start_time_of_computing_relations, 2)
-    relations_stats = {'pair conflicts': total_pair_conflicts,
-                       'triple conflicts': total_triple_conflicts,
-                       'relations time': computing_relations_running_time}
-    return components, relations_stats
+    return components, relations_stats(components, computing_relations_running_time)
+
+
+def relations_stats(components, running_time):
+    stats = {'pair conflicts': sum(len(comp.conflicts) for comp in components),
+             'triple conflicts': sum(len(comp.triple_conflicts) for comp in components),
+             'triple conflicts time': round(sum(comp.triple_conflicts_time for comp in components), 2),
+             'relations time': running_time}
+    if any(comp.intersecting_pairs.sketch is not None for comp in components):
+        stats['sketch decisions'] = sum(comp.sketch_decisions for comp in components)
+        stats['sketch rejections'] = sum(comp.sketch_rejections for comp in components)
+        stats['exact fallbacks'] = sum(comp.exact_fallbacks for comp in components)
+        stats['exact decisions'] = sum(comp.exact_decisions for comp in components)
+    return stats
 
 
-def compute_independent_set(components):
+def compute_independent_set(components, graph_solver='greedy', hypergraph_solver='greedy'):
+    """The solvers are names from the solver registries of independent_set, solver functions or SizeRouters."""
+
+    check_hypergraph_solver(hypergraph_solver)  # before any component is solved
     start_time_of_computing_indp_set = time.process_time()
+    for comp in components:
+        with stage('independent set', comp):
+            if comp.triple_conflicts:
+                comp.indp_set = solve_hypergraph_mis(comp.queries, comp.conflicts, comp.triple_conflicts,
+                                                     hypergraph_solver)
+                count('hyperedges', len(comp.conflicts) + len(comp.triple_conflicts), comp)
+            else:
+                comp.indp_set = solve_graph_mis(comp.queries, comp.conflicts, graph_solver)
+                count('graph edges', len(comp.conflicts), comp)
+        comp.all_elms = set(np.concatenate([q.elms for q in comp.indp_set]).tolist())
+    indp_set_running_time = round(time.process_time() - start_time_of_computing_indp_set, 2)
+    return indp_set_stats(components, indp_set_running_time)
+
+
+def indp_set_stats(components, running_time):
     total_indp_set_weight = 0
     total_vertices_weight = 0
     for comp in components:
-        if comp.triple_conflicts:
-            comp.indp_set = solve_hypergraph_mis(comp.queries, comp.conflicts, comp.triple_conflicts)
-        else:
-            comp.indp_set = solve_graph_mis(comp.queries, comp.conflicts)
-        comp.all_elms = set.union(*[q.elms for q in comp.indp_set])
         total_vertices_weight += comp.w
         total_indp_set_weight += sum(q.w for q in comp.indp_set)
-    indp_set_running_time = round(time.process_time() - start_time_of_computing_indp_set, 2)
-    indp_set_stats = {'weight of independent set': total_indp_set_weight,
-                      'total weight of graph': total_vertices_weight,
-                      'ratio of IS to V': round(total_indp_set_weight / total_vertices_weight, 3),
-                      'indp_set time': indp_set_running_time}
-    return indp_set_stats
+    return {'weight of independent set': total_indp_set_weight,
+            'total weight of graph': total_vertices_weight,
+            'ratio of IS to V': round(total_indp_set_weight / total_vertices_weight, 3),
+            'indp_set time': running_time}
 
 
 def verify(components):
-    def verify_union_rule(cat):
-        union = set()
-        for ch in cat.children:
-            union |= ch.actual_elms
-        assert union.issubset(cat.actual_elms)
-        for child in cat.children:
-            verify_union_rule(child)
-
-    def verify_copy_bound(elm, cats):
-        containing_cats = [cat for cat in cats if elm in cat.actual_elms]
-        assert len(containing_cats) < 2
-        if containing_cats:
-            cont_cat = containing_cats[0]
-            children = cont_cat.children
-            if children:
-                verify_copy_bound(elm, children)
+    def verify_union_rule(cat, children_elms):
+        assert np.isin(children_elms, cat.actual_elms).all()
+
+    def verify_copy_bound(children_elms, all_elms):
+        # with the union rule, an element is in two categories of a level iff it is in two children of one category
+        elms, counts = np.unique(children_elms, return_counts=True)
+        assert not np.isin(elms[counts > 1], all_elms, assume_unique=True).any()
 
     for comp in components:
-        verify_union_rule(comp.root)
-        for e in comp.all_elms:
-            verify_copy_bound(e, [comp.root])
+        all_elms = to_elm_array(comp.all_elms)
+        for cat in preorder(comp.root):
+            if cat.children:
+                children_elms = np.concatenate([ch.actual_elms for ch in cat.children])
+                verify_union_rule(cat, children_elms)
+                verify_copy_bound(children_elms, all_elms)
     print('Verified!')
 
 
 def print_tree(components):
-    def print_tree_recursively(cat):
-        if cat.depth > 0:
-            print('--' * cat.depth, cat.name)
-        for child in cat.children:
-            print_tree_recursively(child)
-
     for comp in components:
-        print_tree_recursively(comp.root)
+        for cat, depth in preorder_with_depth(comp.root):
+            if depth > 0:
+                print('--' * depth, cat.name)
 
 
 def compute_tree_score(components, sim_func, total_weight, trivial_weight):
+    """Scores all queries of each component in batch over a CoverIndex of its tree."""
+
     covered_weight = trivial_weight
     for comp in components:
-        for q in comp.queries:
-            if check_if_covered(q, comp.root, sim_func):
-                covered_weight += q.w
+        with stage('score', comp):
+            for q, is_covered in zip(comp.queries, CoverIndex(comp.root).covered(comp.queries, sim_func)):
+                if is_covered:
+                    covered_weight += q.w
     score = covered_weight / total_weight
     return round(score, 3)
 
 
-def check_if_covered(q, cat, sim_func):
-    q_elms, cat_elms = q.elms, cat.actual_elms
-    if cat_elms.isdisjoint(q_elms):
-        return False
-    return sim_func.is_covering(q_elms, cat_elms) or any(
-        check_if_covered(q, ch, sim_func) for ch in cat.children)
-
-
 
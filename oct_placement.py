@@ -1,89 +1,83 @@
+import heapq
 import math
 import time
-from itertools import combinations
+from itertools import count
 
+import numpy as np
+
+from elements import ELM_DTYPE, contains, inter_size, isin_sorted, to_elm_array, union
+from instrumentation import count as count_event, stage, timed
 from oct import add_to_list_in_dict, Category
+from scoring import CoverIndex
+from tree_walk import ancestors, first_path_end, postorder, preorder, TreeIndex
 
 
+@timed('tree')
 def compute_tree(components, sim_func, merge_threshold):
-    def compute_max_depth(cat):
-        if cat.children:
-            return max(compute_max_depth(child) for child in cat.children)
-        return cat.depth
-
-    def compute_num_categories(cat):
-        if cat.children:
-            return 1 + sum(compute_num_categories(child) for child in cat.children)
-        else:
-            return 1
-
     def compute_core_tree():
         def add_child(p, c):
             p.children.append(c)
             c.parent = p
-            c.depth = p.depth + 1
-
-        def compute_direct_parents():
-            for c in components:
-                indp_ancestors = {}
-                indp_children = c.indp_set & c.must_dict.keys()
-                for qr in indp_children:
-                    parents = set(c.must_dict[qr]) & c.indp_set
-                    if parents:
-                        indp_ancestors[qr] = parents
-                for qr in indp_ancestors:
-                    parents = indp_ancestors[qr]
-                    grandparents = set()
-                    for p in parents:
-                        if p in indp_ancestors:
-                            grandparents.update(indp_ancestors[p])
-                    dir_parents = list(parents - grandparents)
-                    assert len(dir_parents) == 1
-                    c.direct_parents[qr] = dir_parents[0]
-
-        def compute_elms(catg):
-            for ch in catg.children:
-                ch_elms = compute_elms(ch)
-                catg.elms.update(ch_elms)
-            catg.actual_elms = catg.elms.copy()
-            return catg.elms
-
-        compute_direct_parents()
+
+        def compute_direct_parents(c):
+            indp_ancestors = {}
+            indp_children = c.indp_set & c.must_dict.keys()
+            for qr in indp_children:
+                parents = set(c.must_dict[qr]) & c.indp_set
+                if parents:
+                    indp_ancestors[qr] = parents
+            for qr in indp_ancestors:
+                parents = indp_ancestors[qr]
+                grandparents = set()
+                for p in parents:
+                    if p in indp_ancestors:
+                        grandparents.update(indp_ancestors[p])
+                dir_parents = list(parents - grandparents)
+                assert len(dir_parents) == 1
+                c.direct_parents[qr] = dir_parents[0]
+
+        def compute_elms(root):
+            # the query of a category gets the elements of the subtree too: the original implementation shared one
+            # set between the two, and the published results depend on it
+            for catg in postorder(root):
+                if catg.children:
+                    catg.elms = union([catg.elms] + [ch.elms for ch in catg.children])
+                catg.actual_elms = catg.elms
+                if catg.query:
+                    catg.query.elms = catg.elms
+
         for comp in components:
-            qs = sorted(comp.indp_set, reverse=True)
-            for q in qs:
-                cat = Category(q.name, q)
-                comp.categories_index[cat.name] = cat
-                if q in comp.direct_parents:
-                    parent = comp.categories_index[comp.direct_parents[q].name]
-                    add_child(parent, cat)
-                else:
-                    add_child(comp.root, cat)
-            compute_elms(comp.root)
+            with stage('core tree', comp):
+                compute_direct_parents(comp)
+                qs = sorted(comp.indp_set, reverse=True)
+                for q in qs:
+                    cat = Category(q.name, q)
+                    comp.categories_index[cat.name] = cat
+                    if q in comp.direct_parents:
+                        parent = comp.categories_index[comp.direct_parents[q].name]
+                        add_child(parent, cat)
+                    else:
+                        add_child(comp.root, cat)
+                compute_elms(comp.root)
 
     def compute_total_weight_covered(only_indp_set=False):
-        def check_cover(qr, catg, sim_func):
-            if qr.elms.isdisjoint(catg.actual_elms):
-                return False
-            return sim_func.is_covering(qr.elms, catg.actual_elms,sim_func) or any(
-                check_cover(qr, ch, sim_func) for ch in catg.children)
-
         for comp in components:
             comp.covered = comp.covered_before_expand.copy()
-            for q in comp.indp_set - comp.covered_before_expand:
-                cat = comp.categories_index[q.name]
-                if check_cover_of_indp_q(q, cat, sim_func):
-                    comp.covered.add(q)
+            cover_index = CoverIndex(comp.root)
+            qs = list(comp.indp_set - comp.covered_before_expand)
+            cats = [comp.categories_index[q.name] for q in qs]
+            comp.covered.update(q for q, is_covered in zip(qs, cover_index.covered_on_path(qs, cats, sim_func))
+                                if is_covered)
             if not only_indp_set:
-                for q in set(comp.queries) - comp.indp_set:
-                    if check_cover(q, comp.root, sim_func):
-                        comp.covered.add(q)
+                qs = list(set(comp.queries) - comp.indp_set)
+                comp.covered.update(q for q, is_covered in zip(qs, cover_index.covered(qs, sim_func)) if is_covered)
         return sum(q.w for comp in components for q in comp.covered)
 
     # build core tree with duplicates
     start_time_of_tree_building = time.process_time()
     compute_core_tree()
-    initial_max_depth = max(compute_max_depth(comp.root) for comp in components)
+    tree_indexes = [TreeIndex(comp.root) for comp in components]
+    initial_max_depth = max(index.max_depth() for index in tree_indexes)
 
     if sim_func.name not in ['Perfect-Recall', 'Exact']:
         # remove duplicates
@@ -92,8 +86,9 @@ def compute_tree(components, sim_func, merge_threshold):
         # expand tree
         total_weight_covered_before_expand = compute_total_weight_covered(only_indp_set=True)
         expand_tree(components, merge_threshold)
-        after_expand_max_depth = max(compute_max_depth(comp.root) for comp in components)
-        after_expand_num_categories = sum(compute_num_categories(comp.root) for comp in components)
+        tree_indexes = [TreeIndex(comp.root) for comp in components]
+        after_expand_max_depth = max(index.max_depth() for index in tree_indexes)
+        after_expand_num_categories = sum(len(index) for index in tree_indexes)
         tree_building_running_time = round(time.process_time() - start_time_of_tree_building, 2)
         total_weight_covered = compute_total_weight_covered(only_indp_set=True)
         weight_gained_by_expanding = total_weight_covered - total_weight_covered_before_expand
@@ -108,8 +103,8 @@ def compute_tree(components, sim_func, merge_threshold):
                       'total time': tree_building_running_time}
     elif sim_func.name == 'Perfect-Recall':
         tree_building_running_time = round(time.process_time() - start_time_of_tree_building, 2)
-        num_categories = sum(compute_num_categories(comp.root) for comp in components)
-        num_elms = sum(len(set.union(*[q.elms for q in comp.indp_set])) for comp in components)
+        num_categories = sum(len(index) for index in tree_indexes)
+        num_elms = sum(len(comp.all_elms) for comp in components)
         total_weight_covered = sum(q.w for comp in components for q in compute_cover_of_indp_set(comp, sim_func))
         tree_stats = {'depth': initial_max_depth,
                       'categories': num_categories,
@@ -119,95 +114,122 @@ def compute_tree(components, sim_func, merge_threshold):
 
 
 def compute_cover_of_indp_set(comp, sim_func):
-        covered_queries = set()
-        for q in comp.indp_set:
-            cat = comp.categories_index[q.name]
-            is_covered = check_cover_of_indp_q(q, cat, sim_func)
-            if is_covered:
-                covered_queries.add(q)
-        return covered_queries
+    """The queries of the independent set covered by their own category or one of its ancestors."""
+
+    qs = list(comp.indp_set)
+    cats = [comp.categories_index[q.name] for q in qs]
+    is_covered = CoverIndex(comp.root).covered_on_path(qs, cats, sim_func)
+    return {q for q, covered in zip(qs, is_covered) if covered}
 
 def fix_duplicates(components, sim_func):
-    def is_duplicate(el, cat):
-        if el not in cat.actual_elms:
-            return False
-        containing_children = [child for child in cat.children if el in child.actual_elms]
-        if len(containing_children) > 1:
-            return True
-        if not containing_children:
-            return False
-        assert len(containing_children) == 1
-        return is_duplicate(el, containing_children[0])
-
-    def remove_dup(el, cat):
-        if el in cat.actual_elms:
-            cat.actual_elms.remove(el)
-            for child in cat.children:
-                remove_dup(el, child)
-
-    def find_containing_cats(elm, cat, elms_dict, not_covered):
-        if elm in cat.elms:
-            if cat.query and cat.depth > 0 and cat.query in not_covered and elm in cat.query.elms:
-                add_to_list_in_dict(elms_dict, cat, elm)
-            for child in cat.children:
-                find_containing_cats(elm, child, elms_dict, not_covered)
+    def find_duplicates(cats):
+        # an element is a duplicate iff at some category it appears in more than one child branch
+        found = set()
+        for cat in reversed(cats):
+            if len(cat.children) > 1:
+                elms = np.sort(np.concatenate([child.elms for child in cat.children]))
+                found.update(elms[1:][elms[1:] == elms[:-1]].tolist())
+        return found
+
+    def find_containing_cats(cats, dups, not_covered):
+        # the uncovered categories whose queries contain duplicates, ordered by their first duplicate (in the
+        # iteration order of dups) and then in preorder, each with its duplicates in the iteration order of dups
+        dup_positions = {e: i for i, e in enumerate(dups)}
+        containing = []
+        for i, cat in enumerate(cats):
+            if cat.query and cat.query in not_covered and cat.depth > 0:
+                positions = sorted(dup_positions[e] for e in cat.query if e in dup_positions)
+                if positions:
+                    containing.append((positions[0], i, cat, positions))
+        containing.sort(key=lambda c: c[:2])
+        dups_list = list(dups)
+        return {cat: [dups_list[i] for i in positions] for _, _, cat, positions in containing}
 
     total_dupl_elms = 0
     total_elms_in_tree = sum(len(comp.all_elms) for comp in components)
     total_weight_covered_after_removal = 0
     for comp in components:
-        # find all duplicates (elements that appear in multiple branches)
-        dups = set()
-        for e in comp.all_elms:
-            if is_duplicate(e, comp.root):
-                dups.add(e)
-        total_dupl_elms += len(dups)
-        covered_queries_before_removal = compute_cover_of_indp_set(comp, sim_func)
-
-        # find all containing categories for duplicates and remove the duplicates
-        for e in dups:
-            remove_dup(e, comp.root)
-        covered_queries_after_removal = compute_cover_of_indp_set(comp, sim_func)
-        total_weight_covered_after_removal += sum(q.w for q in covered_queries_after_removal)
-        uncovered = covered_queries_before_removal - covered_queries_after_removal
-        dupl_elms_dict = {}  # keys are categories
-        for e in dups:
-            find_containing_cats(e, comp.root, dupl_elms_dict, uncovered)
-
-        # # VERIFY
-        # for cat in dupl_elms_dict:
-        #     assert len(dupl_elms_dict[cat]) == len(cat.query.elms - cat.actual_elms)
-        #     assert cat.query in uncovered
-        #     assert len(uncovered) == len(dupl_elms_dict)
-
-        # place each duplicate in one branch
-        place_duplicates(dups, dupl_elms_dict, sim_func)
-        if dups:
-            distribute_remaining(dups, comp.root)
-        covered_queries_final = compute_cover_of_indp_set(comp, sim_func)
-        comp.covered_before_expand = covered_queries_final
+        with stage('fix duplicates', comp):
+            # find all duplicates (elements that appear in multiple branches) in one bottom-up pass
+            cats = list(preorder(comp.root))
+            found = find_duplicates(cats)
+            dups = {e for e in comp.all_elms if e in found}
+            total_dupl_elms += len(dups)
+            count_event('duplicates', len(dups), comp)
+            covered_queries_before_removal = compute_cover_of_indp_set(comp, sim_func)
+
+            # remove the duplicates and find all their containing categories
+            if dups:
+                dups_array = to_elm_array(dups)
+                for cat in cats:
+                    cat.actual_elms = np.setdiff1d(cat.actual_elms, dups_array, assume_unique=True)
+            covered_queries_after_removal = compute_cover_of_indp_set(comp, sim_func)
+            total_weight_covered_after_removal += sum(q.w for q in covered_queries_after_removal)
+            uncovered = covered_queries_before_removal - covered_queries_after_removal
+            dupl_elms_dict = find_containing_cats(cats, dups, uncovered)  # keys are categories
+
+            # # VERIFY
+            # for cat in dupl_elms_dict:
+            #     assert len(dupl_elms_dict[cat]) == len(cat.query.elms - cat.actual_elms)
+            #     assert cat.query in uncovered
+            #     assert len(uncovered) == len(dupl_elms_dict)
+
+            # place each duplicate in one branch
+            with stage('place duplicates', comp):
+                place_duplicates(dups, dupl_elms_dict, sim_func, comp)
+            if dups:
+                with stage('distribute remaining', comp):
+                    distribute_remaining(dups, comp)
+            covered_queries_final = compute_cover_of_indp_set(comp, sim_func)
+            comp.covered_before_expand = covered_queries_final
     return total_elms_in_tree, total_dupl_elms
 
 
-def distribute_remaining(dups, root):
-    def find_leaves(el, cat, lvs):
-        assert el in cat.elms
-        containing_children = [ch for ch in cat.children if el in ch.elms]
-        if not containing_children:
-            lvs.append(cat)
-        else:
-            for ch in containing_children:
-                find_leaves(el, ch, lvs)
-
+def distribute_remaining(dups, comp):
+    def find_leaves():
+        # the categories containing each element none of whose children does, in preorder; only the elements
+        # found in a category are looked up in its children
+        root = comp.root
+        dups_array = to_elm_array(dups)
+        assert isin_sorted(dups_array, root.elms).all()
+        leaves = {e: [] for e in dups}
+        found_in = {id(root): dups_array}
+        for cat in preorder(root):
+            in_cat = found_in.pop(id(cat), None)
+            if in_cat is None:
+                continue
+            in_children = []
+            for ch in cat.children:
+                in_child = in_cat[isin_sorted(in_cat, ch.elms)]
+                if in_child.size:
+                    found_in[id(ch)] = in_child
+                    in_children.append(in_child)
+            if in_children:
+                in_cat = in_cat[~np.isin(in_cat, np.concatenate(in_children))]
+            for e in in_cat.tolist():
+                leaves[e].append(cat)
+        return leaves
+
+    count_event('duplicates distributed', len(dups), comp)
+    leaves = find_leaves()
+    num_added = {}  # elements given to each category so far (by id), added to its actual elements at the end
+    placed = []
     for e in dups:
-        leaves = []
-        find_leaves(e, root, leaves)
-        assert leaves
-        chosen_leaf = min(leaves, key=lambda ct: len(ct.actual_elms) / ct.query.w)
-        add_elm_to_leaf(e, chosen_leaf)
+        assert leaves[e]
+        chosen_leaf = min(leaves[e], key=lambda ct: (len(ct.actual_elms) + num_added.get(id(ct), 0)) / ct.query.w)
+        placed.append((e, chosen_leaf))
+        for cat in ancestors(chosen_leaf):
+            num_added[id(cat)] = num_added.get(id(cat), 0) + 1
+    add_elms_to_leaves(placed)
 
 
-def place_duplicates(dups, dupl_elms_dict, sim_func):
+def place_duplicates(dups, dupl_elms_dict, sim_func, comp):
+    """Greedily completes the closest uncovered categories with their duplicates.
+    Categories are popped from a heap keyed by closeness score (ties broken by their initial order); a category
+    re-scored after losing duplicates is pushed again and its stale entries are skipped when popped.
+    The duplicates of each category are kept in a dict (as an ordered set), and a reverse index from each
+    duplicate to its categories limits the re-scoring to the affected ones."""
+
     def get_closeness_score(catg):
         c_elms, q_elms = catg.actual_elms, catg.query.elms
         if sim_func.is_covering(q_elms, c_elms):
@@ -216,29 +238,41 @@ def place_duplicates(dups, dupl_elms_dict, sim_func):
         num_missing = math.ceil(x)
         if num_missing - x > 0.99999:
             num_missing -= 1
-        if num_missing > len(dupl_elms_dict[cat]):
+        if num_missing > len(dupl_elms_dict[catg]):
             return 0, 0
         closeness_score = num_missing / catg.query.w
         return closeness_score, num_missing
 
-    closeness_dict = {}
-    for cat in set(dupl_elms_dict.keys()):
+    elm_cats = {}
+    for cat in dupl_elms_dict:
+        dupl_elms_dict[cat] = dict.fromkeys(dupl_elms_dict[cat])
+        for e in dupl_elms_dict[cat]:
+            add_to_list_in_dict(elm_cats, e, cat)
+
+    num_dups = len(dups)
+    closeness_dict = {}  # values are (closeness score, num missing, heap position)
+    heap = []
+    for pos, cat in enumerate(set(dupl_elms_dict.keys())):
         result = get_closeness_score(cat)
         if result[0] == 0:
             raise Exception('covered query in uncovered dict')
         else:
-            closeness_dict[cat] = result
-
-    while closeness_dict and dups:
-        chosen_cat = min(closeness_dict.keys(), key=lambda catgr: closeness_dict[catgr][0])
+            closeness_dict[cat] = result + (pos,)
+            heap.append((result[0], pos, cat))
+    heapq.heapify(heap)
+
+    while heap and dups:
+        score, pos, chosen_cat = heapq.heappop(heap)
+        if chosen_cat not in closeness_dict or closeness_dict[chosen_cat][0] != score:
+            continue  # stale entry
         missing = closeness_dict[chosen_cat][1]
-        chosen_elms = add_elms_to_cat(chosen_cat, missing, dupl_elms_dict)
+        chosen_elms = add_elms_to_cat(chosen_cat, missing, dupl_elms_dict, elm_cats)
         affected_cats = set()
         for e in chosen_elms:
             dups.remove(e)
-            for ct in dupl_elms_dict.keys():
-                if e in dupl_elms_dict[ct]:
-                    dupl_elms_dict[ct].remove(e)
+            for ct in elm_cats.pop(e):
+                if ct in dupl_elms_dict:
+                    del dupl_elms_dict[ct][e]
                     affected_cats.add(ct)
         for cat in affected_cats:
             result = get_closeness_score(cat)
@@ -246,16 +280,30 @@ def place_duplicates(dups, dupl_elms_dict, sim_func):
                 del dupl_elms_dict[cat]
                 del closeness_dict[cat]
             else:
-                closeness_dict[cat] = result
-
-
-def add_elm_to_leaf(e, leaf):
-    leaf.actual_elms.add(e)
-    if leaf.parent:
-        add_elm_to_leaf(e, leaf.parent)
-
-
-def add_elms_to_cat(chosen_cat, missing, dupl_elms_dict):
+                pos = closeness_dict[cat][2]
+                closeness_dict[cat] = result + (pos,)
+                heapq.heappush(heap, (result[0], pos, cat))
+    count_event('duplicates placed', num_dups - len(dups), comp)
+
+
+def add_elms_to_leaves(placed):
+    """Adds every element of the (element, leaf) pairs to its leaf and the ancestors of the leaf, with one union
+    per category."""
+
+    leaves, by_leaf = {}, {}
+    for e, leaf in placed:
+        leaves[id(leaf)] = leaf
+        add_to_list_in_dict(by_leaf, id(leaf), e)
+    cats, new_elms = {}, {}
+    for key, elms in by_leaf.items():
+        for cat in ancestors(leaves[key]):
+            cats[id(cat)] = cat
+            new_elms.setdefault(id(cat), []).extend(elms)
+    for key, elms in new_elms.items():
+        cats[key].actual_elms = union([cats[key].actual_elms, np.array(elms, dtype=ELM_DTYPE)])
+
+
+def add_elms_to_cat(chosen_cat, missing, dupl_elms_dict, elm_cats):
     def get_all_cats_on_same_branch(cat):
         cats = {cat}
         new_cat = cat
@@ -271,58 +319,68 @@ def add_elms_to_cat(chosen_cat, missing, dupl_elms_dict):
             relevant_children = [ch for ch in new_cat.children if ch in dupl_elms_dict]
         return cats
 
-    def add_elm_to_cat(e, cat):
-        def find_leaf(el, catg):
-            relevant_children = [ch for ch in catg.children if el in ch.elms]
-            if not relevant_children or not relevant_children[0]:
-                return catg
-            else:
-                return find_leaf(el, relevant_children[0])
-
-        leaf = find_leaf(e, cat)
-        assert leaf and e in leaf.elms
-        add_elm_to_leaf(e, leaf)
+    def find_leaf(e, cat):
+        leaf = first_path_end(cat, lambda ch: contains(ch.elms, e))
+        assert leaf and contains(leaf.elms, e)
+        return leaf
 
-    branch_cats = get_all_cats_on_same_branch(chosen_cat)
     relevant_elms = {e for e in dupl_elms_dict[chosen_cat]}
     if len(relevant_elms) <= missing:
         chosen_elms = relevant_elms
     else:
-        freq_dict = {e: 1 for e in relevant_elms}
-        for ct in branch_cats - {chosen_cat}:
-            for e in (set(dupl_elms_dict[ct]) & relevant_elms):
-                freq_dict[e] += 1
+        # the frequency of an element is the number of categories on the branch still missing it
+        branch_cats = get_all_cats_on_same_branch(chosen_cat)
+        freq_dict = {e: sum(1 for ct in elm_cats[e] if ct in branch_cats)
+                     for e in relevant_elms}
         chosen_elms = sorted(relevant_elms, key=lambda el: freq_dict[el], reverse=True)[: missing]
-    for e in chosen_elms:
-        add_elm_to_cat(e, chosen_cat)
+    add_elms_to_leaves([(e, find_leaf(e, chosen_cat)) for e in chosen_elms])
     return chosen_elms
 
 
-def check_cover_of_indp_q(q, cat, sim_func):
-    is_covered = sim_func.is_covering(q.elms, cat.actual_elms)
-    if is_covered:
-        return True
-    if cat.parent:
-        return check_cover_of_indp_q(q, cat.parent, sim_func)
-    return False
 
 
 
+def intersecting_pairs(cats, chunk_size=1 << 20):
+    """Returns (i, j, intersection size) for the intersecting pairs i < j of the categories, in the order of
+    combinations. The elements of all categories are sorted together with their positions, so each run of equal
+    elements gives the pairs of its categories; the pairs are generated about chunk_size at a time."""
+
+    def add_up(keys, counts):
+        # the distinct keys, sorted, with the sums of their counts
+        order = np.argsort(keys, kind='stable')
+        keys, counts = keys[order], counts[order]
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        return keys[starts], np.add.reduceat(counts, starts)
+
+    n = len(cats)
+    elms = np.concatenate([cat.elms for cat in cats])
+    owners = np.repeat(np.arange(n), [len(cat.elms) for cat in cats])
+    order = np.lexsort((owners, elms))
+    elms, owners = elms[order], owners[order]
+    later = np.searchsorted(elms, elms, side='right') - np.arange(len(elms)) - 1  # equal elements after each one
+    ends = np.cumsum(later)
+    keys, counts = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    start = 0
+    while start < len(elms):
+        stop = max(int(np.searchsorted(ends, (ends[start - 1] if start else 0) + chunk_size, side='right')), start + 1)
+        chunk = later[start:stop]
+        firsts = np.repeat(np.arange(start, stop), chunk)
+        if len(firsts):
+            seconds = firsts + 1 + np.arange(len(firsts)) - np.repeat(np.cumsum(chunk) - chunk, chunk)
+            keys, counts = add_up(np.concatenate([keys, owners[firsts] * n + owners[seconds]]),
+                                  np.concatenate([counts, np.ones(len(firsts), dtype=np.int64)]))
+        start = stop
+    return zip((keys // n).tolist(), (keys % n).tolist(), counts.tolist())
 
 
 def expand_tree(components, merge_threshold):
     def add_intermediate_categories(categ):
         def merge_cats(cat1, cat2):
-            def update_depths(cat, diff):
-                cat.depth += diff
-                for ch in cat.children:
-                    update_depths(ch, diff)
-
             new_name = cat1.name + '::' + cat2.name
-            new_elms = cat1.elms | cat2.elms
-            new_actual_elms = cat1.actual_elms | cat2.actual_elms
-            new_depth = cat1.depth
-            new_catg = Category(name=new_name, query=None, depth=new_depth)
+            new_elms = union([cat1.elms, cat2.elms])
+            new_actual_elms = union([cat1.actual_elms, cat2.actual_elms])
+            new_catg = Category(name=new_name, query=None)
+            count_event('merges', 1, comp)
             new_catg.elms = new_elms
             new_catg.actual_elms = new_actual_elms
             parent = cat1.parent
@@ -331,50 +389,59 @@ def expand_tree(components, merge_threshold):
             parent.children.remove(cat1)
             parent.children.remove(cat2)
             parent.children.append(new_catg)
-            update_depths(cat1, 1)
-            update_depths(cat2, 1)
             cat1.parent = new_catg
             cat2.parent = new_catg
             return new_catg
 
         def get_initial_pairs(ct):
-            if len(ct.children) < 3:
-                return []
+            inter_sizes = {u: {} for u in ct.children}
             cands = []
-            for u, v in combinations(ct.children, 2):
-                if not u.elms.isdisjoint(v.elms):
-                    inter = len(v.elms & u.elms)
-                    min_len = min(len(u.elms), len(v.elms))
-                    ratio = inter / min_len
-                    if ratio >= merge_threshold:
-                        cands.append((frozenset([u, v]), ratio))
-            return cands
-
-        def update_candidates(cands, new_cat, ct1, ct2):
-            def get_ratio(v, u):
-                inter = len(v.elms & u.elms)
-                min_l = min(len(u.elms), len(v.elms))
-                return inter / min_l
-
-            children = new_cat.parent.children
-            if len(children) < 3:
-                return []
-            new_candidates = [c for c in cands if ct1 not in c[0] and ct2 not in c[0]]
-            for ch in children:
-                if ch.name != new_cat.name and (not ch.elms.isdisjoint(new_cat.elms)):
-                    ratio = get_ratio(new_cat, ch)
-                    if ratio >= merge_threshold:
-                        new_candidates.append((frozenset([new_cat, ch]), ratio))
-            return new_candidates
-
-        candidates = get_initial_pairs(categ)
+            if len(ct.children) < 3:
+                return inter_sizes, cands
+            for i, j, inter in intersecting_pairs(ct.children):
+                u, v = ct.children[i], ct.children[j]
+                inter_sizes[u][v] = inter_sizes[v][u] = inter
+                min_len = min(len(u.elms), len(v.elms))
+                ratio = inter / min_len
+                if ratio >= merge_threshold:
+                    cands.append((-ratio, len(cands), frozenset([u, v])))
+            heapq.heapify(cands)
+            return inter_sizes, cands
+
+        def update_candidates(cands, inter_sizes, new_cat, ct1, ct2):
+            # the intersection of a sibling with the merged category is bounded by the sum of its intersections
+            # with the two merged ones, so the exact size is computed only when the bound reaches the threshold
+            inter_sizes1, inter_sizes2 = inter_sizes.pop(ct1), inter_sizes.pop(ct2)
+            inter_sizes[new_cat] = {}
+            for ch in new_cat.parent.children:
+                if ch.name == new_cat.name:
+                    continue
+                inter = inter_sizes1.get(ch, 0) + inter_sizes2.get(ch, 0)
+                if not inter:
+                    continue
+                min_l = min(len(ch.elms), len(new_cat.elms))
+                if inter / min_l >= merge_threshold:
+                    inter = inter_size(new_cat.elms, ch.elms)
+                    ratio = inter / min_l
+                    if inter and ratio >= merge_threshold:
+                        heapq.heappush(cands, (-ratio, next(seq), frozenset([new_cat, ch])))
+                if inter:
+                    inter_sizes[new_cat][ch] = inter_sizes[ch][new_cat] = inter
+
+        # a max-heap of candidate pairs by ratio, ties broken by the order of creation;
+        # pairs of already merged categories are dropped when popped
+        inter_sizes, candidates = get_initial_pairs(categ)
+        seq = count(len(candidates))
         while len(categ.children) > 2 and candidates:
-            max_pair = max(candidates, key=lambda p: p[1])
-            catg1, catg2 = max_pair[0]
+            _, _, pair = heapq.heappop(candidates)
+            if any(cat not in inter_sizes for cat in pair):
+                continue
+            catg1, catg2 = pair
             new_category = merge_cats(catg1, catg2)
-            candidates = update_candidates(candidates, new_category, catg1, catg2)
-        for child in categ.children:
-            add_intermediate_categories(child)
+            update_candidates(candidates, inter_sizes, new_category, catg1, catg2)
 
     for comp in components:
-        add_intermediate_categories(comp.root)
+        with stage('expand tree', comp):
+            # preorder reads the children of a category only after it has been expanded
+            for cat in preorder(comp.root):
+                add_intermediate_categories(cat)
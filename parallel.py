@@ -0,0 +1,135 @@
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from cache import indp_set_positions, relations_positions, restore_relations
+from instrumentation import Instruments, active, instrumented, timed
+from oct import Component, compute_relations, compute_independent_set, pack_tree, unpack_tree
+from oct_placement import compute_tree
+from tree_walk import ancestors, preorder
+
+
+_worker_state = {}
+
+
+def init_worker(sim_func, merge_threshold, graph_solver, hypergraph_solver, keep_positions=False,
+                instruments_settings=None):
+    """Pool initializer holding the parameters of build_component in every worker."""
+
+    _worker_state.update(sim_func=sim_func, merge_threshold=merge_threshold, graph_solver=graph_solver,
+                         hypergraph_solver=hypergraph_solver, keep_positions=keep_positions,
+                         instruments_settings=instruments_settings)
+
+
+def build_component(job):
+    """Runs relations, MIS, core tree, duplicates fixing and expansion for a single connected component.
+    Returns the stats of every stage, the relations and the independent set as positions of queries, the tree
+    packed into flat arrays, and the records of the stages when the parent process is instrumented."""
+
+    settings = _worker_state['instruments_settings']
+    if settings is None:
+        return build_component_stages(job)
+    with instrumented(Instruments(**settings)) as instruments:
+        result = build_component_stages(job)
+    result['instruments'] = instruments.records()
+    return result
+
+
+def build_component_stages(job):
+
+    rank, queries, intersecting_pairs = job
+    sim_func, merge_threshold = _worker_state['sim_func'], _worker_state['merge_threshold']
+    components, relations_stats = compute_relations([(queries, intersecting_pairs)], sim_func, rank)
+    indp_set_stats = compute_independent_set(components, _worker_state['graph_solver'],
+                                             _worker_state['hypergraph_solver'])
+    comp = components[0]
+    result = {'rank': rank,
+              'relations': relations_stats,
+              'independent set': indp_set_stats,
+              'indp_set': [q.r for q in comp.indp_set],
+              'relations positions': relations_positions(comp)}
+    if _worker_state['keep_positions']:
+        result['indp set positions'] = indp_set_positions(comp)
+    if sim_func.name != 'Exact':
+        total_weight_covered, tree_stats = compute_tree(components, sim_func, merge_threshold)
+        result['tree'] = tree_stats
+        result['weight covered'] = total_weight_covered
+        result['packed tree'] = pack_tree(comp.root)
+    return result
+
+
+def restore_component(queries, intersecting_pairs, result, sim_func):
+    """Rebuilds in the parent process the component built by build_component: its relations (with the triple
+    conflicts), its independent set and its tree, with the categories index and the direct parents."""
+
+    comp = Component(queries, intersecting_pairs, result['rank'], sim_func)
+    qs = comp.queries
+    restore_relations(comp, *result['relations positions'])
+    queries_by_rank = {q.r: q for q in qs}
+    comp.indp_set = {queries_by_rank[r] for r in result['indp_set']}
+    comp.all_elms = set(np.concatenate([q.elms for q in comp.indp_set]).tolist())
+    if 'packed tree' in result:
+        comp.root = unpack_tree(result.pop('packed tree'), qs)
+        for cat in preorder(comp.root):
+            if cat.query:
+                comp.categories_index[cat.name] = cat
+                parent = next((ct for ct in ancestors(cat.parent) if ct.query), None)
+                if parent:
+                    comp.direct_parents[cat.query] = parent.query
+    return comp
+
+
+def merge_stats(stats_dicts):
+    """Aggregates per-component stats: depths are maximized, ratios recomputed and everything else summed."""
+
+    merged = {}
+    for stats in stats_dicts:
+        for k, v in stats.items():
+            if k not in merged:
+                merged[k] = v
+            elif 'depth' in k:
+                merged[k] = max(merged[k], v)
+            else:
+                merged[k] += v
+    for k in merged:
+        if 'time' in k:
+            merged[k] = round(merged[k], 2)
+    if 'ratio of IS to V' in merged:
+        merged['ratio of IS to V'] = round(merged['weight of independent set'] / merged['total weight of graph'], 3)
+    return merged
+
+
+@timed('pool')
+def build_components_in_pool(comps, sim_func, merge_threshold, processes=None, graph_solver='greedy',
+                             hypergraph_solver='greedy', cache=None, data_stats=None):
+    """Builds the tree of every connected component in a process pool, largest components first so that the
+    giant component does not straggle at the end. Returns the components (with their independent sets and
+    unpacked trees, see restore_component) and the aggregated stats of every stage. With an ArtifactCache (that
+    preprocessed the components into data_stats), the relations and independent sets computed by the workers are
+    stored in it."""
+
+    start_time_of_pool = time.time()
+    jobs = [(rank, queries, intersecting_pairs) for rank, (queries, intersecting_pairs) in enumerate(comps)]
+    # the pairs are computed lazily in the workers, so schedule by the total size of the queries
+    jobs = sorted(jobs, key=lambda job: sum(len(q) for q in job[1]), reverse=True)
+    init_args = (sim_func, merge_threshold, graph_solver, hypergraph_solver, cache is not None, active().settings())
+    with Pool(processes, initializer=init_worker, initargs=init_args) as pool:
+        results = sorted(pool.imap_unordered(build_component, jobs, chunksize=1), key=lambda r: r['rank'])
+    if cache is not None:
+        cache.store_stages(sim_func, data_stats, graph_solver, hypergraph_solver,
+                           [r['relations positions'] for r in results], [r['indp set positions'] for r in results])
+
+    components = []
+    for (queries, intersecting_pairs), result in zip(comps, results):
+        comp = restore_component(queries, intersecting_pairs, result, sim_func)
+        if 'instruments' in result:
+            active().merge(result['instruments'], comp)
+        components.append(comp)
+    stats = {'relations': merge_stats(r['relations'] for r in results),
+             'independent set': merge_stats(r['independent set'] for r in results),
+             'wall time': round(time.time() - start_time_of_pool, 2)}
+    if sim_func.name != 'Exact':
+        stats['tree'] = merge_stats(r['tree'] for r in results)
+        stats['weight covered'] = sum(r['weight covered'] for r in results)
+    return components, stats
@@ -0,0 +1,72 @@
+import numpy as np
+
+from elements import ELM_DTYPE
+from tree_walk import TreeIndex
+
+
+class CoverIndex(object):
+    """Index of a category tree for scoring queries in batch. Each element of the tree is mapped to the categories
+    whose actual elements contain it (a path from the root once duplicates are fixed), so the intersection sizes of
+    a batch of queries with all their intersecting categories are counted in one pass, without intersecting sets.
+    Build a new index after the tree or its actual elements change."""
+
+    def __init__(self, root):
+        tree_index = TreeIndex(root)
+        cats = tree_index.cats
+        self.pos = tree_index.pos
+        self.num_cats = len(cats)
+        self.parents = np.array([tree_index.pos[id(cat.parent)] if cat.parent is not None else -1 for cat in cats],
+                                dtype=np.int64)
+        self.cat_lens = np.array([len(cat.actual_elms) for cat in cats], dtype=np.int64)
+        elms = np.concatenate([cat.actual_elms for cat in cats]).astype(ELM_DTYPE, copy=False)
+        owners = np.repeat(np.arange(self.num_cats), self.cat_lens)
+        order = np.lexsort((owners, elms))
+        self.elms, first = np.unique(elms[order], return_index=True)
+        self.elm_cats = owners[order]
+        self.indptr = np.append(first, len(order))
+
+    def count_intersections(self, queries):
+        """Returns (query indices, category positions, intersection sizes) of all intersecting pairs, sorted."""
+
+        q_lens = np.array([len(q.elms) for q in queries], dtype=np.int64)
+        q_elms = np.concatenate([q.elms for q in queries]) if queries else np.zeros(0, dtype=ELM_DTYPE)
+        q_idx = np.repeat(np.arange(len(queries)), q_lens)
+        local = np.searchsorted(self.elms, q_elms)
+        local[local == len(self.elms)] = 0
+        found = self.elms[local] == q_elms if len(self.elms) else np.zeros(len(q_elms), dtype=bool)
+        local, q_idx = local[found], q_idx[found]
+        starts, lens = self.indptr[local], self.indptr[local + 1] - self.indptr[local]
+        cum_lens = np.cumsum(lens)
+        offsets = np.repeat(starts - cum_lens + lens, lens) + np.arange(cum_lens[-1] if len(lens) else 0)
+        keys = np.repeat(q_idx, lens) * self.num_cats + self.elm_cats[offsets]
+        keys, inter = np.unique(keys, return_counts=True)
+        return keys // self.num_cats, keys % self.num_cats, inter
+
+    def covered(self, queries, sim_func):
+        """For each query, whether any category of the tree covers it."""
+
+        q_idx, cat_pos, inter = self.count_intersections(queries)
+        q_lens = np.array([len(q.elms) for q in queries], dtype=np.int64)
+        covering = sim_func.is_covering_batch(q_lens[q_idx], self.cat_lens[cat_pos], inter)
+        is_covered = np.zeros(len(queries), dtype=bool)
+        is_covered[q_idx[covering]] = True
+        return is_covered
+
+    def covered_on_path(self, queries, cats, sim_func):
+        """For each query, whether the given category of the query or one of its ancestors covers it."""
+
+        q_idx, cat_pos, inter = self.count_intersections(queries)
+        inter_keys = q_idx * self.num_cats + cat_pos
+        q_lens = np.array([len(q.elms) for q in queries], dtype=np.int64)
+        is_covered = np.zeros(len(queries), dtype=bool)
+        path_q = np.arange(len(queries))
+        path_pos = np.array([self.pos[id(cat)] for cat in cats], dtype=np.int64)
+        while path_q.size:
+            keys = path_q * self.num_cats + path_pos
+            i = np.minimum(np.searchsorted(inter_keys, keys), max(len(inter_keys) - 1, 0))
+            path_inter = np.where(inter_keys[i] == keys, inter[i], 0) if len(inter_keys) else np.zeros_like(keys)
+            covering = sim_func.is_covering_batch(q_lens[path_q], self.cat_lens[path_pos], path_inter)
+            is_covered[path_q[covering]] = True
+            up = ~covering & (self.parents[path_pos] >= 0)
+            path_q, path_pos = path_q[up], self.parents[path_pos[up]]
+        return is_covered
@@ -1,3 +1,21 @@
+import numpy as np
+
+from elements import inter_size
+from instrumentation import count
+
+
+def relations_from_scores(together, separately, eps):
+    """Batch version of the decision in compute_relation: -1 is a conflict, 1 a must relation and 0 neither.
+    A score of 0 means that the option is impossible."""
+
+    relations = np.zeros(len(together), dtype=np.int8)
+    can_together, can_separately = together != 0, separately != 0
+    relations[~can_together & ~can_separately] = -1
+    must = can_together & (~can_separately | (together > (separately + eps)))
+    relations[must] = 1
+    return relations
+
+
 class Jaccard(object):
     def __init__(self, delta):
         self.name = 'Jaccard'
@@ -7,8 +25,9 @@ class Jaccard(object):
     def __repr__(self):
         return self.name + ' ' + str(self.delta)
 
-    def compute_relation(self, q1, q2):
-        inter = len(q1 & q2)
+    def compute_relation(self, q1, q2, inter=None):
+        if inter is None:
+            inter = len(q1 & q2)
         len_q1, len_q2 = len(q1), len(q2)
         together = self.can_together(len_q1, len_q2, inter)
         separately = self.can_separately(len_q1, len_q2, inter)
@@ -21,6 +40,13 @@ class Jaccard(object):
         else:
             return 0
 
+    def compute_relation_batch(self, len_q1, len_q2, inter):
+        """Vectorized compute_relation over arrays of pair sizes; returns an int8 array of relations."""
+
+        together = self.can_together_batch(len_q1, len_q2, inter)
+        separately = self.can_separately_batch(len_q1, len_q2, inter)
+        return relations_from_scores(together, separately, self.eps)
+
     def can_together(self, q1, q2, inter):
         must_remain = max(inter, self.delta * q2)  # must remain in q2
         lb_extra = must_remain - inter
@@ -31,6 +57,14 @@ class Jaccard(object):
         score = (q1 / (q1 + extra)) + ((inter + extra) / q2)
         return score
 
+    def can_together_batch(self, q1, q2, inter):
+        must_remain = np.maximum(inter, self.delta * q2)
+        lb_extra = must_remain - inter
+        ub_extra = q1 * (1 - self.delta) / self.delta
+        extra = np.minimum(q2 - inter, ub_extra)
+        score = (q1 / (q1 + extra)) + ((inter + extra) / q2)
+        return np.where(lb_extra > (ub_extra - self.eps), 0, score)
+
     def can_separately(self, q1, q2, inter):
         ub_x = min(inter, (1 - self.delta) * q2)  # this is how much q1 can take from inter
         lb_x = inter - (q1 * (1 - self.delta))
@@ -39,14 +73,27 @@ class Jaccard(object):
         score = ((q1 - inter + lb_x) / q1) + ((q2 - lb_x) / q2)
         return score
 
+    def can_separately_batch(self, q1, q2, inter):
+        ub_x = np.minimum(inter, (1 - self.delta) * q2)
+        lb_x = inter - (q1 * (1 - self.delta))
+        score = ((q1 - inter + lb_x) / q1) + ((q2 - lb_x) / q2)
+        return np.where(lb_x > (ub_x - self.eps), 0, score)
+
     def is_covering(self, q, cat):
-        inter = len(q & cat)
+        inter = inter_size(q, cat)
         union = len(q) + len(cat) - inter
         score = (inter / union)
         return score > (self.delta - self.eps)
 
+    def is_covering_batch(self, len_q, len_cat, inter):
+        """Vectorized is_covering over arrays of query sizes, category sizes and intersection sizes."""
+
+        union = len_q + len_cat - inter
+        score = (inter / union)
+        return score > (self.delta - self.eps)
+
     def num_missing(self,q, cat):
-        inter_len = len(set.intersection(cat, q))
+        inter_len = inter_size(q, cat)
         union_len = len(cat) + len(q) - inter_len
         return (union_len * self.delta) - inter_len
 
@@ -60,8 +107,9 @@ class F1(object):
     def __repr__(self):
         return self.name + ' ' + str(self.delta)
 
-    def compute_relation(self, q1, q2):
-        inter = len(set.intersection(q1.elms,q2.elms))
+    def compute_relation(self, q1, q2, inter=None):
+        if inter is None:
+            inter = len(q1 & q2)
         len_q1, len_q2 = len(q1.elms), len(q2.elms)
         together = self.can_together(len_q1, len_q2, inter)
         separately = self.can_separately(len_q1, len_q2, inter)
@@ -74,6 +122,13 @@ class F1(object):
         else:
             return 0
 
+    def compute_relation_batch(self, len_q1, len_q2, inter):
+        """Vectorized compute_relation over arrays of pair sizes; returns an int8 array of relations."""
+
+        together = self.can_together_batch(len_q1, len_q2, inter)
+        separately = self.can_separately_batch(len_q1, len_q2, inter)
+        return relations_from_scores(together, separately, self.eps)
+
     def can_together(self, q1, q2, inter):
         must_remain = max(inter, q2 * (self.delta / 2) / (1 - self.delta / 2))  # must remain in q2
         lb_extra = must_remain - inter
@@ -82,12 +137,22 @@ class F1(object):
             return 0
         extra = min(q2 - inter, ub_extra)
         if extra < 0 or q1 <= 0 or inter > q1 or inter > q2:
-            print('ERROR', q1, q2, inter, ub_extra, lb_extra, extra)
+            count('invalid F1 pairs')
         p1 = q1 / (q1 + extra)
         r2 = (inter + extra) / q2
         score = 2 * ((p1) / (1 + p1) + (r2) / (1 + r2))
         return score
 
+    def can_together_batch(self, q1, q2, inter):
+        must_remain = np.maximum(inter, q2 * (self.delta / 2) / (1 - self.delta / 2))
+        lb_extra = must_remain - inter
+        ub_extra = q1 * (1 - self.delta) / (self.delta / 2)
+        extra = np.minimum(q2 - inter, ub_extra)
+        p1 = q1 / (q1 + extra)
+        r2 = (inter + extra) / q2
+        score = 2 * ((p1) / (1 + p1) + (r2) / (1 + r2))
+        return np.where(lb_extra > (ub_extra - self.eps), 0, score)
+
     def can_separately(self, q1, q2, inter):
         ub_x = min(inter, (1 - self.delta) / (1 - (self.delta / 2)) * q2)  # this is how much q1 can take from inter
         lb_x = inter - (q1 * (1 - self.delta) / (1 - (self.delta / 2)))
@@ -98,8 +163,16 @@ class F1(object):
         score = 2 * ((r1) / (1 + r1) + (r2) / (1 + r2))
         return score
 
+    def can_separately_batch(self, q1, q2, inter):
+        ub_x = np.minimum(inter, (1 - self.delta) / (1 - (self.delta / 2)) * q2)
+        lb_x = inter - (q1 * (1 - self.delta) / (1 - (self.delta / 2)))
+        r1 = (q1 - inter + lb_x) / q1
+        r2 = (q2 - lb_x) / q2
+        score = 2 * ((r1) / (1 + r1) + (r2) / (1 + r2))
+        return np.where(lb_x > (ub_x - self.eps), 0, score)
+
     def is_covering(self, q, cat):
-        inter = len(q & cat)
+        inter = inter_size(q, cat)
         if (not len(cat)) or (not inter):
             return False
         precision = inter / len(cat)
@@ -107,8 +180,17 @@ class F1(object):
         score = 2 * (precision * recall) / (precision + recall)
         return score > (self.delta - self.eps)
 
+    def is_covering_batch(self, len_q, len_cat, inter):
+        """Vectorized is_covering over arrays of query sizes, category sizes and intersection sizes."""
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = inter / len_cat
+            recall = inter / len_q
+            score = 2 * (precision * recall) / (precision + recall)
+        return (len_cat != 0) & (inter != 0) & (score > (self.delta - self.eps))
+
     def num_missing(self,q, cat):
-        inter_len = len(set.intersection(cat, q))
+        inter_len = inter_size(q, cat)
         half_delta = self.delta / 2
         return (half_delta * (len(q) + len(cat)) - inter_len) / (1 - half_delta)
 
@@ -122,25 +204,34 @@ class PerfectRecall(object):
     def __repr__(self):
         return self.name + ' ' + str(self.delta)
 
-    def compute_relation(self, q1, q2):
+    def compute_relation(self, q1, q2, inter=None):
         len_q1, len_q2 = len(q1), len(q2)
-        together = self.can_together(len_q1, len_q2, len(q1 | q2))
+        union = len(q1 | q2) if inter is None else len_q1 + len_q2 - inter
+        together = self.can_together(len_q1, len_q2, union)
         if not together:
             return -1
         return 1
 
+    def compute_relation_batch(self, len_q1, len_q2, inter):
+        together = self.can_together(len_q1, len_q2, len_q1 + len_q2 - inter)
+        return np.where(together, 1, -1).astype(np.int8)
 
     def can_together(self, q1, q2, union):
         precision = q1 / union
         return precision > self.delta + self.eps
 
     def is_covering(self, q, cat):
-        if not q.issubset(cat):
+        inter = inter_size(q, cat)
+        if inter < len(q):
             return False
-        inter = len(q & cat)
         precision = inter / len(cat)
         return precision > (self.delta - self.eps)
 
+    def is_covering_batch(self, len_q, len_cat, inter):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = inter / len_cat
+        return (inter >= len_q) & (precision > (self.delta - self.eps))
+
 
 class Exact(object):
     def __init__(self, delta = 1):
@@ -150,10 +241,18 @@ class Exact(object):
     def __repr__(self):
         return self.name
 
-    def compute_relation(self, q1, q2):
-        if q2.elms.issubset(q1.elms):
+    def compute_relation(self, q1, q2, inter=None):
+        if inter is None:
+            inter = len(q1 & q2)
+        if inter == len(q2):
             return 1
         return -1
 
+    def compute_relation_batch(self, len_q1, len_q2, inter):
+        return np.where(inter == len_q2, 1, -1).astype(np.int8)
+
     def is_covering(self, q, cat):
-        return q.equals(cat)
\ No newline at end of file
+        return len(q) == len(cat) == inter_size(q, cat)
+
+    def is_covering_batch(self, len_q, len_cat, inter):
+        return (len_q == len_cat) & (len_cat == inter)
\ No newline at end of file
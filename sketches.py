@@ -0,0 +1,76 @@
+import numpy as np
+
+
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+class MinHashSketch(object):
+    """Approximate intersection sizes for the pairs of large queries. Queries of at least min_size elements get a
+    MinHash signature of num_hashes values (one minimum per universal hash function), and the Jaccard similarity of
+    two of them is estimated as the fraction of equal minima, with a Wilson score interval of z standard deviations.
+    The cardinalities stay exact, so the interval translates into an interval of intersection sizes."""
+
+    def __init__(self, num_hashes=128, min_size=256, z=3.0, seed=0):
+        self.num_hashes = num_hashes
+        self.min_size = min_size
+        self.z = z
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, MERSENNE_PRIME, size=num_hashes, dtype=np.int64)
+        self.b = rng.integers(0, MERSENNE_PRIME, size=num_hashes, dtype=np.int64)
+
+    def __repr__(self):
+        return 'MinHashSketch(num_hashes=%d, min_size=%d, z=%s, seed=%d)' % (self.num_hashes, self.min_size, self.z,
+                                                                              self.seed)
+
+    def __eq__(self, other):
+        return type(other) is MinHashSketch and repr(self) == repr(other)
+
+    def __hash__(self):
+        return hash(repr(self))
+
+    def is_sketched(self, q):
+        return len(q) >= self.min_size
+
+    def signature(self, elms):
+        """The minima of the hash functions over the elements (ids below 2 ** 31, so a * x fits in 62 bits)."""
+
+        hashes = (self.a[:, None] * elms.astype(np.int64)[None, :] + self.b[:, None]) % MERSENNE_PRIME
+        return hashes.min(axis=1)
+
+    def sign(self, qrs):
+        """Attaches a signature to every query that is large enough and has none yet."""
+
+        for q in qrs:
+            if q.sketch is None and self.is_sketched(q):
+                q.sketch = self.signature(q.elms)
+
+    def jaccard_interval(self, matches):
+        """Wilson score interval of the Jaccard similarity for the given numbers of equal minima."""
+
+        k, z = self.num_hashes, self.z
+        p = matches / k
+        center = (p + z * z / (2 * k)) / (1 + z * z / k)
+        half = z * np.sqrt(p * (1 - p) / k + z * z / (4 * k * k)) / (1 + z * z / k)
+        return p, np.maximum(center - half, 0), np.minimum(center + half, 1)
+
+    def estimate_pairs(self, large_qrs):
+        """Estimates the intersection sizes of all pairs of the given large queries (ordered from largest to
+        smallest). Returns the positions i < j in large_qrs of the (larger, smaller) pairs and arrays of their
+        estimated, lowest and highest intersection sizes."""
+
+        n = len(large_qrs)
+        first, second = np.triu_indices(n, 1)
+        if not len(first):
+            return first, second, np.zeros(0), np.zeros(0), np.zeros(0)
+        signatures = np.array([q.sketch for q in large_qrs]).reshape(n, self.num_hashes)
+        matches = np.concatenate([np.count_nonzero(signatures[i + 1:] == signatures[i], axis=1) for i in range(n - 1)])
+        jaccard, jaccard_lo, jaccard_hi = self.jaccard_interval(matches)
+        lens = np.array([len(q) for q in large_qrs], dtype=np.float64)
+        sizes = lens[first] + lens[second]
+        max_inter = np.minimum(lens[first], lens[second])
+
+        def to_inter(j):  # from J = inter / (|q1| + |q2| - inter)
+            return np.minimum(j * sizes / (1 + j), max_inter)
+
+        return first, second, to_inter(jaccard), to_inter(jaccard_lo), to_inter(jaccard_hi)
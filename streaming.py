@@ -0,0 +1,145 @@
+import asyncio
+import copy
+import json
+import time
+from multiprocessing import Pool
+
+from instrumentation import active
+from oct import compute_relations, compute_independent_set, pack_tree
+from oct_placement import compute_tree
+from parallel import init_worker, build_component, merge_stats, restore_component
+
+
+def iter_component_trees(comps, sim_func, merge_threshold, processes=1, graph_solver='greedy',
+                         hypergraph_solver='greedy'):
+    """Yields (component, tree, stats) for every connected component as soon as its tree is built, where tree is
+    the root category of the component (None for Exact) and stats holds the stats of its stages. Serially the
+    components run from smallest to largest, so the many small trees come out before the giant component is
+    solved; in a process pool (unless processes == 1) the largest start first and the others finish around them.
+    Once the consumer asks for the next result, the relations and the intersecting pairs of the previous component
+    are released, so only the trees the consumer keeps stay in memory."""
+
+    jobs = [(rank, queries, intersecting_pairs) for rank, (queries, intersecting_pairs) in enumerate(comps)]
+    if processes == 1:
+        while jobs:
+            rank, queries, intersecting_pairs = jobs.pop()
+            components, relations_stats = compute_relations([(queries, intersecting_pairs)], sim_func, rank)
+            stats = {'relations': relations_stats,
+                     'independent set': compute_independent_set(components, graph_solver, hypergraph_solver)}
+            if sim_func.name != 'Exact':
+                stats['weight covered'], stats['tree'] = compute_tree(components, sim_func, merge_threshold)
+            comp = components.pop()
+            yield comp, comp.root if sim_func.name != 'Exact' else None, stats
+            release(comp)
+        return
+
+    # the pairs are computed lazily in the workers, so schedule by the total size of the queries
+    jobs = sorted(jobs, key=lambda job: sum(len(q) for q in job[1]), reverse=True)
+    init_args = (sim_func, merge_threshold, graph_solver, hypergraph_solver, False, active().settings())
+    with Pool(processes, initializer=init_worker, initargs=init_args) as pool:
+        for result in pool.imap_unordered(build_component, jobs, chunksize=1):
+            queries, intersecting_pairs = comps[result['rank']]
+            comp = restore_component(queries, intersecting_pairs, result, sim_func)
+            if 'instruments' in result:
+                active().merge(result['instruments'], comp)
+            stats = {'relations': result['relations'], 'independent set': result['independent set']}
+            tree = None
+            if 'tree' in result:
+                tree = comp.root
+                stats['tree'] = result['tree']
+                stats['weight covered'] = result['weight covered']
+            yield comp, tree, stats
+            release(comp)
+
+
+def release(comp):
+    """Drops the relations of a finished component and the intersecting pairs computed for it. The queries, the
+    independent set and the tree are kept for the consumer."""
+
+    comp.conflicts = set()
+    comp.conflicts_dict = {}
+    comp.triple_conflicts = set()
+    comp.must_dict = {}
+    comp.direct_parents = {}
+    comp.categories_index = {}
+    comp.intersecting_pairs.release()
+
+
+async def aiter_component_trees(comps, sim_func, merge_threshold, processes=1, graph_solver='greedy',
+                                hypergraph_solver='greedy'):
+    """Async version of iter_component_trees: the pipeline runs in a worker thread, so an event loop keeps
+    publishing the trees that are already done."""
+
+    results = iter_component_trees(comps, sim_func, merge_threshold, processes, graph_solver, hypergraph_solver)
+    done = object()
+    while True:
+        result = await asyncio.to_thread(next, results, done)
+        if result is done:
+            return
+        yield result
+
+
+class JsonLinesSink(object):
+    """Writes every finished component as one line of JSON: its rank, its stats and its categories in preorder as
+    [name, position of the parent or -1 for a top category, product IDs of the actual elements]. Every line is
+    flushed, so a reader of the file sees whole components as they complete. The product IDs are those of the
+    ElementIndex the components were loaded with, or the element ids without one."""
+
+    def __init__(self, file_name, elm_index=None):
+        self.file_name = file_name
+        self.elm_index = elm_index
+        self.f = open(file_name, 'w')
+
+    def write(self, comp, tree, stats):
+        entry = {'component': comp.rank, 'stats': stats}
+        if tree is not None:
+            packed = pack_tree(tree)
+            offsets, elms = packed['offsets'], packed['elms'].tolist()
+            entry['categories'] = [[name, parent - 1, self.decode(elms[offsets[i]:offsets[i + 1]])]
+                                   for i, (name, parent) in enumerate(zip(packed['names'], packed['parents'].tolist()))
+                                   if i > 0]  # the root of the component is dropped
+        else:
+            entry['independent set'] = sorted(q.name for q in comp.indp_set)
+        self.f.write(json.dumps(entry) + '\n')
+        self.f.flush()
+
+    def decode(self, elms):
+        return self.elm_index.decode(elms) if self.elm_index is not None else elms
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def stream_delta(connected_comps, data_stats, sim_func, delta, merge_threshold, sink, processes=1,
+                 graph_solver='greedy', hypergraph_solver='greedy'):
+    """Like sweep.run_delta, but every component is written to the sink (anything with a write(component, tree,
+    stats) method, such as a JsonLinesSink) as soon as it is done, and released afterwards. Returns the row of
+    results, with the stats of the stages aggregated over the components."""
+
+    start_time_of_streaming = time.time()
+    total_weight, trivial_weight = data_stats['total'], data_stats['trivial']
+    sim_func = copy.copy(sim_func)
+    sim_func.delta = delta
+    all_stats = []
+    for comp, tree, stats in iter_component_trees(connected_comps, sim_func, merge_threshold, processes,
+                                                  graph_solver, hypergraph_solver):
+        sink.write(comp, tree, stats)
+        all_stats.append(stats)
+    row = {'delta': delta}
+    for stage in ('relations', 'independent set', 'tree'):
+        if all_stats and stage in all_stats[0]:
+            row[stage] = merge_stats(stats[stage] for stats in all_stats)
+    if sim_func.name == 'Exact':
+        indp_set_weight = row.get('independent set', {}).get('weight of independent set', 0)
+        row['score'] = round((indp_set_weight + trivial_weight) / total_weight, 3)
+    else:
+        total_weight_covered = sum(stats['weight covered'] for stats in all_stats)
+        row['score'] = round((total_weight_covered + trivial_weight) / total_weight, 3)
+    row['wall time'] = round(time.time() - start_time_of_streaming, 2)
+    return row
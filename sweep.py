@@ -0,0 +1,134 @@
+import copy
+from multiprocessing import Pool
+
+from instrumentation import Instruments, active, instrumented
+from oct import compute_relations, compute_independent_set, compute_tree_score, verify
+from oct_placement import compute_tree
+from parallel import build_components_in_pool
+
+
+_worker_state = {}
+
+
+def run_delta(connected_comps, data_stats, sim_func, delta, merge_threshold, verify_tree=False, processes=1,
+              graph_solver='greedy', hypergraph_solver='greedy', cache=None, verbose=False):
+    """Runs relations, MIS and tree building for one delta over already preprocessed components.
+    The intersection sizes cached in the intersecting pairs are shared by all deltas, so only the
+    classification of each pair is recomputed. Unless processes == 1, the components are built in
+    a process pool and rebuilt from the results of the workers (see parallel.restore_component). With an
+    ArtifactCache (that preprocessed the components), the relations and independent sets are stored in it, and
+    once both are cached the run restores them and starts at tree building.
+    If verbose, the stats of every stage are printed as it finishes (in a pool, once all are done), followed by
+    the score and the output of the verification.
+    Returns the components and a row of results."""
+
+    def show(*stats):
+        if verbose:
+            print(*stats)
+
+    total_weight, trivial_weight = data_stats['total'], data_stats['trivial']
+    sim_func = copy.copy(sim_func)
+    sim_func.delta = delta
+    row = {'delta': delta}
+
+    if processes != 1 and (cache is None or not cache.has_stages(sim_func, data_stats, graph_solver,
+                                                                  hypergraph_solver)):
+        components, pool_stats = build_components_in_pool(connected_comps, sim_func, merge_threshold, processes,
+                                                          graph_solver, hypergraph_solver, cache, data_stats)
+        row.update(pool_stats)
+        total_weight_covered = row.pop('weight covered', None)
+        for stage in ('relations', 'independent set', 'tree'):
+            if stage in row:
+                show(row[stage])
+    elif cache is not None:
+        components, row['relations'] = cache.compute_relations(connected_comps, sim_func, data_stats)
+        show(row['relations'])
+        row['independent set'] = cache.compute_independent_set(components, sim_func, data_stats, graph_solver,
+                                                               hypergraph_solver)
+        show(row['independent set'])
+        if sim_func.name != 'Exact':
+            total_weight_covered, row['tree'] = compute_tree(components, sim_func, merge_threshold)
+            show(row['tree'])
+    else:
+        components, row['relations'] = compute_relations(connected_comps, sim_func)
+        show(row['relations'])
+        row['independent set'] = compute_independent_set(components, graph_solver, hypergraph_solver)
+        show(row['independent set'])
+        if sim_func.name != 'Exact':
+            total_weight_covered, row['tree'] = compute_tree(components, sim_func, merge_threshold)
+            show(row['tree'])
+    if sim_func.name == 'Exact':
+        indp_set_weight = row['independent set']['weight of independent set']
+        row['score'] = round((indp_set_weight + trivial_weight) / total_weight, 3)
+        show('FINAL SCORE:', row['score'])
+    else:  # *not* Exact variant
+        row['score'] = round((total_weight_covered + trivial_weight) / total_weight, 3)
+        show('FINAL SCORE:', row['score'])
+        if verify_tree:
+            row['verified score'] = compute_tree_score(components, sim_func, total_weight, trivial_weight)
+            show('verified score:', row['verified score'])
+            verify(components)
+    return components, row
+
+
+def _init_worker(connected_comps, data_stats, sim_func, merge_threshold, verify_tree, graph_solver,
+                 hypergraph_solver, cache, instruments_settings=None):
+    _worker_state.update(connected_comps=connected_comps, data_stats=data_stats, sim_func=sim_func,
+                         merge_threshold=merge_threshold, verify_tree=verify_tree, graph_solver=graph_solver,
+                         hypergraph_solver=hypergraph_solver, cache=cache, instruments_settings=instruments_settings)
+
+
+def _run_delta_in_worker(delta):
+    """Returns the row of the delta, and the records of its stages when the parent process is instrumented."""
+
+    s = _worker_state
+    args = (s['connected_comps'], s['data_stats'], s['sim_func'], delta, s['merge_threshold'], s['verify_tree'], 1,
+            s['graph_solver'], s['hypergraph_solver'], s['cache'])
+    if s['instruments_settings'] is None:
+        return run_delta(*args)[1], None
+    with instrumented(Instruments(**s['instruments_settings'])) as instruments:
+        row = run_delta(*args)[1]
+    return row, instruments.records()
+
+
+def sweep_deltas(connected_comps, data_stats, sim_func, deltas, merge_threshold, processes=None,
+                 verify_tree=False, graph_solver='greedy', hypergraph_solver='greedy', cache=None):
+    """Runs the pipeline for every delta, in a process pool unless processes == 1.
+    The preprocessed components are sent to each worker once, with their intersecting pairs computed beforehand so
+    that the deltas share them. Returns one row per delta, sorted by delta."""
+
+    init_args = (connected_comps, data_stats, sim_func, merge_threshold, verify_tree, graph_solver, hypergraph_solver,
+                 cache)
+    if processes == 1 or len(deltas) == 1:
+        _init_worker(*init_args)
+        results = [_run_delta_in_worker(delta) for delta in deltas]
+    else:
+        processes = min(processes or len(deltas), len(deltas))
+        for _, intersecting_pairs in connected_comps:
+            intersecting_pairs.materialize()
+        with Pool(processes, initializer=_init_worker, initargs=init_args + (active().settings(),)) as pool:
+            results = pool.map(_run_delta_in_worker, deltas, chunksize=1)
+    for _, records in results:
+        if records is not None:
+            active().merge(records)
+    return sorted((row for row, _ in results), key=lambda r: r['delta'])
+
+
+def print_results_table(rows):
+    columns = ['delta', 'score', 'verified score', 'pair conflicts', 'triple conflicts', 'ratio of IS to V',
+               'categories', 'depth']
+    columns = [col for col in columns if any(col in flatten_row(r) for r in rows)]
+    print('\t'.join(columns))
+    for r in rows:
+        flat = flatten_row(r)
+        print('\t'.join(str(flat.get(col, '')) for col in columns))
+
+
+def flatten_row(row):
+    flat = {}
+    for k, v in row.items():
+        if type(v) is dict:
+            flat.update(v)
+        else:
+            flat[k] = v
+    return flat
@@ -0,0 +1,58 @@
+import json
+
+import numpy as np
+
+
+def generate_query_log(num_queries, seed=0, mean_component_size=50, component_skew=1.0, products_per_query=2.0,
+                       zipf_exponent=1.1, branching=4, recall=0.9, overlap=0.2, max_results=100):
+    """Generates a synthetic query log {query: [product IDs, weight]} in the input format of load_and_preprocess.
+    The same arguments always give the same log.
+
+    The queries are split into groups with disjoint products, the connected components to be: there are
+    num_queries / mean_component_size groups whose sizes follow a Zipf law with exponent component_skew, so there is
+    a giant component and a long tail. The products of a group (products_per_query per query) form a nested
+    brand/category hierarchy with the given branching: the nodes of level l split the products of the group into
+    branching ** l contiguous ranges. A query picks a product by popularity, which is Zipfian with exponent
+    zipf_exponent, and a level, and returns the products of the node of that level containing the product, each kept
+    with probability recall and at most max_results of them (by popularity). With probability overlap a query also
+    returns a few products of another branch, which makes the query overlap without nesting. Query weights are Zipfian
+    as well."""
+
+    rng = np.random.default_rng(seed)
+    num_groups = max(1, num_queries // mean_component_size)
+    group_p = 1 / np.arange(1, num_groups + 1) ** component_skew
+    group_sizes = rng.multinomial(num_queries, group_p / group_p.sum())
+    weights = np.minimum(rng.zipf(2.0, num_queries), 1000).tolist()
+
+    log, first_product, q = {}, 0, 0
+    for group_size in group_sizes[group_sizes > 0].tolist():
+        num_products = max(4, int(group_size * products_per_query))
+        popularity = 1 / rng.permutation(np.arange(1, num_products + 1)) ** zipf_exponent
+        depth = max(1, int(np.ceil(np.log(num_products / 2) / np.log(branching))))
+        # the nodes of the top levels are too large to be returned whole, so queries start at min_level
+        min_level = min(depth, max(0, int(np.ceil(np.log(num_products / (4 * max_results)) / np.log(branching)))))
+        anchors = rng.choice(num_products, size=group_size, p=popularity / popularity.sum())
+        levels = rng.integers(min_level, depth + 1, size=group_size)
+        for anchor, level in zip(anchors.tolist(), levels.tolist()):
+            node_size = num_products / branching ** level
+            start = int(int(anchor / node_size) * node_size)
+            end = max(start + 2, int((int(anchor / node_size) + 1) * node_size))
+            products = np.arange(start, min(end, num_products))
+            products = products[rng.random(len(products)) < recall]
+            if rng.random() < overlap:
+                products = np.union1d(products, rng.integers(0, num_products, size=rng.integers(1, 4)))
+            if len(products) > max_results:
+                keys = np.log(popularity[products]) + rng.gumbel(size=len(products))  # sampling by popularity
+                products = products[np.argpartition(-keys, max_results)[:max_results]]
+            log['q%d' % q] = [['P%08d' % (first_product + p) for p in products.tolist()], weights[q]]
+            q += 1
+        first_product += num_products
+    return log
+
+
+def write_query_log(log, file_name):
+    """Writes a query log as JSON Lines, one query per line."""
+
+    with open(file_name, 'w') as f:
+        for name, entry in log.items():
+            f.write(json.dumps({name: entry}) + '\n')
@@ -0,0 +1,152 @@
+import json
+import struct
+
+import numpy as np
+
+from elements import ELM_DTYPE, encode_strings
+from oct import pack_tree
+
+
+MAGIC = b'CTCRTREE'
+ALIGNMENT = 64
+
+
+def export_tree(components, elm_index, file_name):
+    """Writes the trees of all components as one binary file for serving, see TreeFile. The categories are stored in
+    preorder under a virtual ROOT (position 0, with no elements) whose children are the top categories of all
+    components. The file holds the parent array, the category names, the actual elements of each category and the
+    categories of each element in CSR form, and the product IDs of elm_index, each in a fixed-width array."""
+
+    names, parents, lens, elms = ['ROOT'], [np.full(1, -1, dtype=np.int32)], [np.zeros(1, dtype=np.int64)], []
+    for comp in components:
+        packed = pack_tree(comp.root)
+        base = len(names) - 1  # the root of the component is dropped, its children hang from the virtual ROOT
+        comp_parents = packed['parents'][1:]
+        parents.append(np.where(comp_parents == 0, 0, comp_parents + base).astype(np.int32))
+        names.extend(packed['names'][1:])
+        lens.append(np.diff(packed['offsets'])[1:])
+        elms.append(packed['elms'][packed['offsets'][1]:])
+    lens = np.concatenate(lens)
+    cat_indptr = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum(lens, out=cat_indptr[1:])
+    cat_elms = np.concatenate(elms) if elms else np.zeros(0, dtype=ELM_DTYPE)
+
+    owners = np.repeat(np.arange(len(names), dtype=np.int32), lens)
+    elm_cats = owners[np.lexsort((owners, cat_elms))]
+    elm_indptr = np.zeros(len(elm_index) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cat_elms, minlength=len(elm_index)), out=elm_indptr[1:])
+
+    name_data, name_offsets = encode_strings(names)
+    product_data, product_offsets = encode_strings(elm_index.names)
+    # str order is the order of the utf-8 bytes, so both tables can be searched on the raw bytes
+    arrays = {'parents': np.concatenate(parents),
+              'names': name_data,
+              'name offsets': name_offsets,
+              'name order': np.array(sorted(range(len(names)), key=names.__getitem__), dtype=np.int32),
+              'cat indptr': cat_indptr,
+              'cat elms': cat_elms.astype(ELM_DTYPE),
+              'elm indptr': elm_indptr,
+              'elm cats': elm_cats,
+              'products': product_data,
+              'product offsets': product_offsets,
+              'product order': np.array(sorted(range(len(elm_index)), key=elm_index.names.__getitem__),
+                                        dtype=np.int32)}
+    write_arrays(arrays, file_name)
+
+
+def write_arrays(arrays, file_name):
+    """Writes the arrays after a json header with the dtype, offset and length of each array. Every array starts at a
+    multiple of ALIGNMENT bytes, so it can be viewed in place once the file is mapped."""
+
+    header, offset = {}, 0
+    for name, array in arrays.items():
+        header[name] = [array.dtype.str, offset, len(array)]
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    encoded_header = json.dumps(header).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 8 + len(encoded_header)) // ALIGNMENT) * ALIGNMENT
+    with open(file_name, 'wb') as f:
+        f.write(MAGIC + struct.pack('<q', len(encoded_header)) + encoded_header)
+        for name, array in arrays.items():
+            f.seek(data_start + header[name][1])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + offset)
+
+
+class TreeFile(object):
+    """Read-only view of a file written by export_tree. The file is mapped into memory and every array is a view of
+    the mapping, so opening it reads only the header, and a lookup touches only the pages it needs. Categories are
+    given by name and products by product ID; both are found by binary search over the sorted name tables."""
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.data = np.memmap(file_name, dtype=np.uint8, mode='r')
+        if self.data[:len(MAGIC)].tobytes() != MAGIC:
+            raise ValueError('%s is not a tree file' % file_name)
+        header_len, = struct.unpack('<q', self.data[len(MAGIC):len(MAGIC) + 8].tobytes())
+        header_start = len(MAGIC) + 8
+        header = json.loads(self.data[header_start:header_start + header_len].tobytes().decode('utf-8'))
+        data_start = -(-(header_start + header_len) // ALIGNMENT) * ALIGNMENT
+        self.arrays = {}
+        for name, (dtype, offset, length) in header.items():
+            start = data_start + offset
+            self.arrays[name] = self.data[start:start + length * np.dtype(dtype).itemsize].view(dtype)
+
+    def __len__(self):
+        return len(self.arrays['parents'])
+
+    def name(self, cat):
+        return self.string('names', 'name offsets', cat)
+
+    def product(self, elm):
+        return self.string('products', 'product offsets', elm)
+
+    def string(self, data, offsets, i):
+        offsets = self.arrays[offsets]
+        return self.arrays[data][offsets[i]:offsets[i + 1]].tobytes().decode('utf-8')
+
+    def search(self, order, get, key):
+        """Position of key in a table sorted by the given order, or None."""
+
+        order = self.arrays[order]
+        lo, hi = 0, len(order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if get(int(order[mid])) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(order) and get(int(order[lo])) == key:
+            return int(order[lo])
+        return None
+
+    def find_category(self, name):
+        cat = self.search('name order', self.name, name)
+        if cat is None:
+            raise KeyError(name)
+        return cat
+
+    def find_product(self, product_id):
+        return self.search('product order', self.product, product_id)
+
+    def parent(self, name):
+        """Name of the parent category, or None for the virtual ROOT."""
+
+        parent = int(self.arrays['parents'][self.find_category(name)])
+        return self.name(parent) if parent >= 0 else None
+
+    def categories_of(self, product_id):
+        """Names of the categories containing the product, from the top category down. Empty for products that
+        are in no category (or unknown)."""
+
+        elm = self.find_product(product_id)
+        if elm is None:
+            return []
+        indptr = self.arrays['elm indptr']
+        return [self.name(cat) for cat in self.arrays['elm cats'][indptr[elm]:indptr[elm + 1]].tolist()]
+
+    def products_of(self, name):
+        """Product IDs of the actual elements of the category, which include those of its descendants."""
+
+        indptr = self.arrays['cat indptr']
+        cat = self.find_category(name)
+        return [self.product(elm) for elm in self.arrays['cat elms'][indptr[cat]:indptr[cat + 1]].tolist()]
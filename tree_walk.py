@@ -0,0 +1,88 @@
+def preorder(root):
+    """Yields the categories of the subtree of root in preorder, children in their order."""
+
+    stack = [root]
+    while stack:
+        cat = stack.pop()
+        yield cat
+        stack.extend(reversed(cat.children))
+
+
+def preorder_with_depth(root):
+    """Yields (category, depth relative to root) in preorder."""
+
+    stack = [(root, 0)]
+    while stack:
+        cat, depth = stack.pop()
+        yield cat, depth
+        stack.extend((child, depth + 1) for child in reversed(cat.children))
+
+
+def postorder(root):
+    """Returns the categories of the subtree of root with every category after its descendants."""
+
+    order, stack = [], [root]
+    while stack:
+        cat = stack.pop()
+        order.append(cat)
+        stack.extend(cat.children)
+    return reversed(order)
+
+
+def first_path_end(cat, keep):
+    """Follows the first child for which keep is true, and returns the category where no such child exists."""
+
+    while True:
+        child = next((ch for ch in cat.children if keep(ch)), None)
+        if child is None:
+            return cat
+        cat = child
+
+
+def ancestors(cat):
+    """Yields the category itself and then its ancestors up to the root."""
+
+    while cat is not None:
+        yield cat
+        cat = cat.parent
+
+
+class TreeIndex(object):
+    """Aggregates of a tree computed in one walk: the preorder (Euler tour) position of each category, its depth,
+    the size of its subtree and the maximal depth below it. The subtree of a category is the interval
+    [pos, pos + size) of the preorder. Categories are keyed by identity; build a new index after the tree changes."""
+
+    def __init__(self, root):
+        self.cats, self.depths = [], []
+        for cat, depth in preorder_with_depth(root):
+            self.cats.append(cat)
+            self.depths.append(depth)
+        self.pos = {id(cat): i for i, cat in enumerate(self.cats)}
+        self.sizes = [1] * len(self.cats)
+        self.max_depths = list(self.depths)
+        for i in range(len(self.cats) - 1, 0, -1):
+            p = self.pos[id(self.cats[i].parent)]
+            self.sizes[p] += self.sizes[i]
+            self.max_depths[p] = max(self.max_depths[p], self.max_depths[i])
+
+    def __len__(self):
+        return len(self.cats)
+
+    def depth(self, cat):
+        return self.depths[self.pos[id(cat)]]
+
+    def subtree_size(self, cat):
+        return self.sizes[self.pos[id(cat)]]
+
+    def max_depth(self, cat=None):
+        return self.max_depths[self.pos[id(cat)] if cat is not None else 0]
+
+    def subtree(self, cat):
+        i = self.pos[id(cat)]
+        return self.cats[i:i + self.sizes[i]]
+
+    def is_ancestor(self, a, b):
+        """True if a is b or one of its ancestors."""
+
+        i, j = self.pos[id(a)], self.pos[id(b)]
+        return i <= j < i + self.sizes[i]